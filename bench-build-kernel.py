@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Copyright (C) 2019 Adek Maulana
+
+'''
+Benchmark for the non-compile parts of build-kernel.py.
+
+Everything runs inside a throwaway $HOME: a fake kernel tree, stub make,
+clang, strip, sign-file and jarsigner, synthetic AnyKernel templates and
+local stand-ins for AFH (FTP), GoogleDrive and Telegram, so the numbers
+only measure build-kernel.py itself.
+'''
+
+import importlib.util
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import traceback
+import tracemalloc
+import types
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import dirname, join, realpath
+from shutil import rmtree
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from tempfile import mkdtemp
+from time import perf_counter
+
+scriptdir = dirname(realpath(__file__))
+
+# name: (files, total size in bytes)
+TEMPLATES = {
+    'small': (20, 1 << 20),
+    'medium': (200, 10 << 20),
+    'large': (1000, 50 << 20)
+}
+
+STUB_MAKE = '''#!/bin/sh
+out=.
+for arg in "$@"; do
+    case "$arg" in
+        O=*) out="${arg#O=}" ;;
+        *_defconfig) mkdir -p "$out" && touch "$out/.config" && exit 0 ;;
+    esac
+done
+awk -v n="$BENCH_MAKE_LINES" 'BEGIN {
+    for (i = 0; i < n; i++)
+        printf "  CC      drivers/staging/prima/CORE/file_%d.o\\n", i
+}'
+mkdir -p "$out/arch/arm64/boot" "$out/drivers/staging/prima"
+head -c "$BENCH_IMAGE_SIZE" /dev/urandom > "$out/arch/arm64/boot/Image.gz-dtb"
+head -c "$BENCH_MODULE_SIZE" /dev/urandom \\
+    > "$out/drivers/staging/prima/wlan.ko"
+'''
+
+STUB_CLANG = '''#!/bin/sh
+echo "Android (5484270 based on r353983c) clang version 9.0.3 \\
+(https://android.googlesource.com/toolchain/clang) Target: aarch64"
+'''
+
+# reads the whole zip once, roughly what jarsigner's digesting costs
+STUB_JARSIGNER = '''#!/bin/sh
+cat > /dev/null
+for arg in "$@"; do
+    case "$arg" in
+        *.zip) cat "$arg" > /dev/null ;;
+    esac
+done
+'''
+
+STUB_NOOP = '''#!/bin/sh
+exit 0
+'''
+
+
+def write_stub(path, content):
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as stub:
+        stub.write(content)
+    os.chmod(path, 0o755)
+
+
+def fake_home(home):
+    kernel = join(home, 'kernel')
+    with open(join(home, 'keystore_password'), 'w') as kp:
+        kp.write('password=bench\n')
+    with open(join(home, 'pass'), 'w') as afh:
+        afh.write('bench\n')
+    with open(join(home, 'token'), 'w') as token:
+        token.write('0:bench\n')
+    source = join(kernel, 'mido')
+    os.makedirs(source)
+    with open(join(source, 'Makefile'), 'w') as makefile:
+        makefile.write('# fake kernel tree\n')
+    write_stub(join(source, 'scripts/sign-file'), STUB_NOOP)
+    tcdir = join(kernel, 'toolchain')
+    write_stub(join(tcdir, 'google-clang/bin/clang'), STUB_CLANG)
+    write_stub(join(tcdir, 'google-clang/bin/llvm-strip'), STUB_NOOP)
+    bindir = join(home, 'bin')
+    write_stub(join(bindir, 'make'), STUB_MAKE)
+    write_stub(join(bindir, 'jarsigner'), STUB_JARSIGNER)
+    write_stub(join(bindir, 'ccache'), '#!/bin/sh\nexec "$@"\n')
+    outdir = join(kernel, 'build/out/target/kernel/mido/miui')
+    os.makedirs(outdir)
+    for key in ['signing_key.priv', 'signing_key.x509']:
+        open(join(outdir, key), 'w').close()
+    os.makedirs(join(kernel,
+                     'build/out/target/kernel/zip/mido/miui/CPUQuiet'))
+    # scriptdir of build-kernel.py, holds the keystore and ledgers
+    os.makedirs(join(home, 'scripts/bin'))
+    open(join(home, 'scripts/bin/stormguard.keystore'), 'w').close()
+    return bindir
+
+
+def fake_template(anykernel, files, size):
+    rmtree(anykernel, ignore_errors=True)
+    moduledir = join(anykernel, 'modules/system/lib/modules')
+    os.makedirs(join(moduledir, 'pronto'))
+    os.makedirs(join(anykernel, 'tools'))
+    os.makedirs(join(anykernel, 'META-INF/com/google/android'))
+    with open(join(anykernel, 'anykernel.sh'), 'w') as ak:
+        ak.write('#!/sbin/sh\n' + '# anykernel config\n' * 200)
+    # half text that deflates well, half binary that doesn't
+    chunk = size // files
+    for i in range(files):
+        if i % 2 == 0:
+            data = (b'ramdisk patch line %d\n' % i) * (chunk // 22 + 1)
+            data = data[:chunk]
+        else:
+            data = os.urandom(chunk)
+        with open(join(anykernel, 'tools', f'blob-{i}'), 'wb') as blob:
+            blob.write(data)
+
+
+class FTPHandler(StreamRequestHandler):
+    # just enough of RFC 959 for ftplib login/storbinary/delete
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.reply('220 bench')
+        passive = None
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                break
+            cmd, _, arg = line.partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'USER':
+                self.reply('331 password please')
+            elif cmd in ['PASS', 'TYPE']:
+                self.reply('230 ok' if cmd == 'PASS' else '200 ok')
+            elif cmd == 'PASV':
+                passive = socket.socket()
+                passive.bind(('127.0.0.1', 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)'
+                           % (port >> 8, port & 0xff))
+            elif cmd == 'STOR':
+                self.reply('150 go ahead')
+                conn = passive.accept()[0]
+                received = 0
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    received += len(data)
+                conn.close()
+                passive.close()
+                self.server.stored[arg] = received
+                self.reply('226 done')
+            elif cmd == 'DELE':
+                self.server.stored.pop(arg, None)
+                self.reply('250 deleted')
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('502 not implemented')
+
+
+class TelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"ok": true}')
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRequest(object):
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeDriveFiles(object):
+    # Drive in a JSON file: list/create with md5Checksum and appProperties
+    # like files().v3, stages run in their own process
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as store:
+            return json.load(store)
+
+    def list(self, q=None, **kwargs):
+        return FakeRequest({'files': list(self.load().values())})
+
+    def create(self, body, fields, media_body=None):
+        import hashlib
+        store = self.load()
+        file_id = 'id%d' % len(store)
+        entry = {'id': file_id, 'name': body['name'],
+                 'parents': body['parents']}
+        if 'appProperties' in body:
+            entry['appProperties'] = body['appProperties']
+        if media_body is not None:
+            md5 = hashlib.md5()
+            with open(media_body.filepath, 'rb') as media:
+                while True:
+                    data = media.read(256 << 10)
+                    if not data:
+                        break
+                    md5.update(data)
+            entry['md5Checksum'] = md5.hexdigest()
+        store[file_id] = entry
+        with open(self.path, 'w') as output:
+            json.dump(store, output)
+        return FakeRequest({'id': file_id})
+
+
+class FakeDrive(object):
+    def __init__(self, path):
+        self.path = path
+
+    def files(self):
+        return FakeDriveFiles(self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stand_ins(bk, home):
+    from ftplib import FTP
+    ftp = ThreadingTCPServer(('127.0.0.1', 0), FTPHandler)
+    ftp.stored = {}
+    serve(ftp)
+    telegram = serve(HTTPServer(('127.0.0.1', 0), TelegramHandler))
+    drive = FakeDrive(join(home, 'drive.json'))
+
+    class LocalFTP(FTP):
+        def __init__(self, host='', *args, **kwargs):
+            FTP.__init__(self)
+            self.connect('127.0.0.1', ftp.server_address[1])
+
+    def post(url, params=None):
+        from urllib.parse import urlencode
+        from urllib.request import urlopen
+        port = telegram.server_address[1]
+        response = urlopen(f'http://127.0.0.1:{port}/sendMessage',
+                           data=urlencode(params).encode())
+        response.status_code = response.status
+        return response
+
+    class MediaFileUpload(object):
+        def __init__(self, filepath, mimetype=None, resumable=False):
+            self.filepath = filepath
+
+    import ftplib
+    ftplib.FTP = LocalFTP
+    requests = types.ModuleType('requests')
+    requests.post = post
+    http = types.ModuleType('googleapiclient.http')
+    http.MediaFileUpload = MediaFileUpload
+    sys.modules['requests'] = requests
+    sys.modules['googleapiclient'] = types.ModuleType('googleapiclient')
+    sys.modules['googleapiclient.http'] = http
+    bk.GoogleDrive.service = drive
+    return ftp, telegram, drive
+
+
+def load_build_kernel(home):
+    # build-kernel.py isn't importable by name, and reads its own path
+    # from sys.argv[0] to find scriptdir
+    spec = importlib.util.spec_from_file_location(
+        'build_kernel', join(scriptdir, 'build-kernel.py'))
+    bk = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bk)
+    return bk
+
+
+def measure(results, stage, func, *args):
+    # every stage in a fresh process, RUSAGE_CHILDREN is the high-water
+    # mark of all children reaped so far, not of this stage's ones
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        status = 1
+        try:
+            tracemalloc.start()
+            begin = perf_counter()
+            func(*args)
+            elapsed = perf_counter() - begin
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with os.fdopen(write_end, 'w') as output:
+                json.dump({
+                    'seconds': elapsed,
+                    'peak_python_bytes': peak,
+                    'maxrss_children_kb': resource.getrusage(
+                        resource.RUSAGE_CHILDREN).ru_maxrss
+                }, output)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+    os.close(write_end)
+    with os.fdopen(read_end, 'r') as result:
+        data = result.read()
+    status = os.waitpid(pid, 0)[1]
+    if status != 0:
+        raise RuntimeError(f'{stage} failed')
+    results.setdefault(stage, []).append(json.loads(data))
+
+
+def set_args(home, *extra):
+    sys.argv = [join(home, 'scripts/build-kernel.py'),
+                '-b', 'miui', '-d', 'mido', '-c', '-v', 'bench',
+                '-cc', 'clang'] + list(extra)
+
+
+def run(params):
+    home = mkdtemp(prefix='bench-build-kernel-')
+    results = {}
+    try:
+        os.environ['HOME'] = home
+        os.environ['PATH'] = fake_home(home) + os.pathsep + os.environ['PATH']
+        os.environ['BENCH_MAKE_LINES'] = str(params['make_lines'])
+        os.environ['BENCH_IMAGE_SIZE'] = str(params['image_size'])
+        os.environ['BENCH_MODULE_SIZE'] = str(params['module_size'])
+        set_args(home)
+        bk = load_build_kernel(home)
+        ftp, telegram, drive = stand_ins(bk, home)
+        os.chdir(join(home, 'kernel/mido'))
+        anykernel = bk.variables()['anykernel']
+        finalzip = bk.variables()['finalzip']
+        for _ in range(params['runs']):
+            measure(results, 'subprocess_run', bk.subprocess_run, 'make')
+            measure(results, 'make', bk.make)
+            for size in params['templates']:
+                fake_template(anykernel, *TEMPLATES[size])
+                measure(results, f'zip_now[{size}]', bk.zip_now, finalzip)
+            measure(results, 'finalzip_sign', bk.finalzip_sign, finalzip)
+            measure(results, 'md5sum_zip', bk.md5sum_zip, finalzip)
+            # fresh remote state, otherwise dedup skips every upload
+            drive.clear()
+            ledger = join(home, 'scripts/afh-uploads.json')
+            if os.path.exists(ledger):
+                os.remove(ledger)
+            set_args(home, '-u', '-t')
+            measure(results, 'Uploads', bk.Uploads, 'mido', 'bench',
+                    bk.variables()['zipname'], finalzip)
+            measure(results, 'afh_upload', bk.afh_upload,
+                    bk.variables()['zipname'], finalzip)
+            measure(results, 'Uploads[dedup]', bk.Uploads, 'mido', 'bench',
+                    bk.variables()['zipname'], finalzip)
+            set_args(home)
+        ftp.shutdown()
+        telegram.shutdown()
+    finally:
+        os.chdir(scriptdir)
+        rmtree(home, ignore_errors=True)
+    return results
+
+
+def report(results):
+    print('%-20s %10s %10s %14s %14s' % ('stage', 'min (s)', 'mean (s)',
+                                         'py peak (KiB)', 'rss ch. (KiB)'))
+    for stage, runs in results.items():
+        seconds = [r['seconds'] for r in runs]
+        print('%-20s %10.3f %10.3f %14d %14d' % (
+            stage, min(seconds), sum(seconds) / len(seconds),
+            max(r['peak_python_bytes'] for r in runs) // 1024,
+            max(r['maxrss_children_kb'] for r in runs)))
+    print('%-20s %50d' % ('maxrss self (KiB)', resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss))
+
+
+def parameters():
+    param = ArgumentParser(description='build-kernel.py pipeline '
+                                       'benchmark.', )
+    param.add_argument('-n', '--runs', type=int, default=3)
+    param.add_argument('--templates', nargs='+', choices=list(TEMPLATES),
+                       default=['small', 'medium', 'large'])
+    param.add_argument('--make-lines', dest='make_lines', type=int,
+                       default=20000,
+                       help='Lines of output the stub make prints.')
+    param.add_argument('--image-size', dest='image_size', type=int,
+                       default=14 << 20)
+    param.add_argument('--module-size', dest='module_size', type=int,
+                       default=4 << 20)
+    param.add_argument('-j', '--json', help='Also write results to this '
+                                            'JSON file.')
+    return vars(param.parse_args())
+
+
+def main():
+    params = parameters()
+    results = run(params)
+    report(results)
+    if params['json'] is not None:
+        with open(params['json'], 'w') as output:
+            json.dump({'params': params, 'results': results}, output,
+                      indent=4)
+
+
+if __name__ == '__main__':
+    main()
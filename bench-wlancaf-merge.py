@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Copyright (C) 2019 Adek Maulana
+
+'''
+Benchmark for wlancaf-merge.py on synthetic CAF history.
+
+Bare repos shaped like fw-api, qca-wifi-host-cmn, qcacld-3.0 and prima
+are generated with git fast-import, a given number of commits between
+every tag, next to a synthetic kernel tree.  Each run copies the kernel
+tree, merges the second to last tag with --init initial and the last one
+with --init update, timing both end to end and per step from --report.
+History is deterministic, so results of different commits of the script
+(--script) are comparable.
+'''
+
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from os.path import dirname, exists, join, realpath
+from shutil import copytree, rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+scriptdir = dirname(realpath(__file__))
+
+CAF_URL = ('https://source.codeaurora.org/quic/la/platform/vendor/'
+           'qcom-opensource/wlan')
+
+REPOS = {
+    'qcacld': ['fw-api', 'qca-wifi-host-cmn', 'qcacld-3.0'],
+    'prima': ['prima']
+}
+
+# signs nothing, but git still pipes every commit through it
+FAKE_GPG = '''#!/bin/sh
+cat > /dev/null
+echo "[GNUPG:] SIG_CREATED D 1 8 00 0 BENCH" >&2
+printf -- "-----BEGIN PGP SIGNATURE-----\\n\\nbench\\n"
+printf -- "-----END PGP SIGNATURE-----\\n"
+'''
+
+STAGING_KCONFIG = '''menu "Staging drivers"
+
+config STAGING
+\tbool "Staging drivers"
+
+if STAGING
+
+endif # STAGING
+
+endmenu
+'''
+
+
+def tag_name(index):
+    return 'LA.UM.8.2.r1-%05d-sdm660.0' % ((index + 1) * 100)
+
+
+def blob(lines, seed):
+    return ''.join(['/* %s line %d */\n' % (seed, line)
+                    for line in range(lines)]).encode()
+
+
+def fast_import(path, stream, bare=True):
+    cmd = ['git', 'init', '-q']
+    if bare is True:
+        cmd.append('--bare')
+    subprocess.run(cmd + [path], check=True)
+    subprocess.run(['git', 'fast-import', '--quiet'], input=stream,
+                   cwd=path, check=True)
+
+
+def caf_stream(repos, params):
+    # commit n touches file n % files, the first one adds all of them
+    stream = []
+    files = params['files']
+    when = 1500000000
+    mark = 0
+    for index in range(params['tags']):
+        for commit in range(params['commits']):
+            mark += 1
+            message = ('%s: change %d\n' % (repos, mark)).encode()
+            stream.append(b'commit refs/heads/master\nmark :%d\n'
+                          b'committer CAF <caf@localhost> %d +0000\n'
+                          b'data %d\n%s' % (mark, when + mark,
+                                            len(message), message))
+            if mark > 1:
+                stream.append(b'from :%d\n' % (mark - 1))
+                changed = [(mark - 1) % files]
+            else:
+                changed = range(files)
+                if repos in ['qcacld-3.0', 'prima']:
+                    stream.append(b'M 100644 inline Kconfig\ndata 13\n'
+                                  b'config BENCH\n')
+            for number in changed:
+                data = blob(params['lines'], '%s %d %d'
+                            % (repos, number, mark))
+                stream.append(b'M 100644 inline core/file_%d.c\n'
+                              b'data %d\n%s\n' % (number, len(data), data))
+            stream.append(b'\n')
+        stream.append(b'reset refs/tags/%s\nfrom :%d\n\n'
+                      % (tag_name(index).encode(), mark))
+    return b''.join(stream)
+
+
+def kernel_stream(params):
+    stream = [b'commit refs/heads/master\nmark :1\n'
+              b'committer Kernel <kernel@localhost> 1400000000 +0000\n'
+              b'data 5\ninit\n']
+    files = {
+        'Makefile': b'VERSION = 4\nPATCHLEVEL = 4\n',
+        'drivers/staging/Kconfig': STAGING_KCONFIG.encode(),
+        'drivers/staging/Makefile': b'obj-$(CONFIG_ANDROID)\t+= android/\n'
+    }
+    for number in range(params['kernel_files']):
+        files['drivers/misc/file_%d.c' % number] = blob(params['lines'],
+                                                        number)
+    for path, data in sorted(files.items()):
+        stream.append(b'M 100644 inline %s\ndata %d\n%s\n'
+                      % (path.encode(), len(data), data))
+    return b''.join(stream) + b'\n'
+
+
+def generate(workdir, params):
+    caf = join(workdir, 'caf')
+    for repos in sorted(set(sum([REPOS[w] for w in params['wlan']], []))):
+        print(f' -> Generating {repos}...')
+        fast_import(join(caf, repos), caf_stream(repos, params))
+        # --fetch blobless, missing blobs are fetched by id later on, as
+        # partial clone servers allow
+        for key in ['uploadpack.allowFilter',
+                    'uploadpack.allowAnySHA1InWant']:
+            subprocess.run(['git', 'config', key, 'true'],
+                           cwd=join(caf, repos), check=True)
+    print(' -> Generating kernel tree...')
+    kernel = join(workdir, 'kernel')
+    fast_import(kernel, kernel_stream(params), bare=False)
+    subprocess.run(['git', 'checkout', '-q', 'master'], cwd=kernel,
+                   check=True)
+    gpg = join(workdir, 'fake-gpg')
+    with open(gpg, 'w') as fake:
+        fake.write(FAKE_GPG)
+    os.chmod(gpg, 0o755)
+    for key, value in [('user.name', 'Bench'),
+                       ('user.email', 'bench@localhost'),
+                       ('user.signingkey', 'BENCH'), ('gpg.program', gpg)]:
+        subprocess.run(['git', 'config', key, value], cwd=kernel,
+                       check=True)
+    return caf, kernel
+
+
+def supports(script, option):
+    # older commits of wlancaf-merge.py may not know every option yet
+    with open(script, 'r') as source:
+        return f"'{option}'" in source.read()
+
+
+def merge(results, stage, cmd, cwd, report_file):
+    # reaped with wait4, so maxrss is this merge's process tree only,
+    # RUSAGE_CHILDREN would be the high-water mark of every earlier one
+    begin = perf_counter()
+    merged = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+    output = merged.stdout.read()
+    merged.stdout.close()
+    status, usage = os.wait4(merged.pid, 0)[1:]
+    elapsed = perf_counter() - begin
+    merged.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                         else -os.WTERMSIG(status))
+    if merged.returncode != 0:
+        print(output)
+        raise subprocess.CalledProcessError(merged.returncode, cmd)
+    steps = {}
+    if exists(report_file):
+        with open(report_file, 'r') as report_json:
+            for entry in json.load(report_json)['repos'].values():
+                for step, seconds in entry['steps'].items():
+                    steps[step] = steps.get(step, 0) + seconds
+        os.remove(report_file)
+    results.setdefault(stage, []).append({
+        'seconds': elapsed,
+        'steps': steps,
+        'maxrss_children_kb': usage.ru_maxrss
+    })
+
+
+def run(params):
+    workdir = mkdtemp(prefix='bench-wlancaf-merge-')
+    results = {}
+    script = params['script']
+    # nothing from the user's git config, fixed dates for the commits
+    os.environ['HOME'] = workdir
+    os.environ['GIT_CONFIG_NOSYSTEM'] = '1'
+    os.environ['GIT_COMMITTER_DATE'] = '1600000000 +0000'
+    os.environ['GIT_AUTHOR_DATE'] = '1600000000 +0000'
+    try:
+        caf, kernel = generate(workdir, params)
+        # scripts without -U/--url fetch from CAF itself
+        subprocess.run(['git', 'config', '--global',
+                        'url.%s.insteadOf' % caf, CAF_URL], check=True)
+        fetches = params['fetch']
+        if not supports(script, '--fetch'):
+            print(' -> No --fetch in this script, benchmarking its own '
+                  'fetch as tags...')
+            fetches = ['tags']
+        initial_tag = tag_name(params['tags'] - 2)
+        update_tag = tag_name(params['tags'] - 1)
+        for wlan in params['wlan']:
+            for engine in params['engine']:
+                for fetch in fetches:
+                    name = f'{wlan}:{engine}:{fetch}'
+                    print(f' -> Benchmarking {name}...')
+                    for _ in range(params['runs']):
+                        tree = join(workdir, 'run')
+                        rmtree(tree, ignore_errors=True)
+                        copytree(kernel, tree, symlinks=True)
+                        report_file = join(workdir, 'report.json')
+                        cmd = [sys.executable, script, '-W', wlan]
+                        if supports(script, '--url'):
+                            cmd += ['-U', caf]
+                        if supports(script, '--fetch'):
+                            cmd += ['-F', fetch]
+                        if engine != 'porcelain':
+                            cmd += ['--engine', engine]
+                        if supports(script, '--report'):
+                            cmd += ['--report', report_file]
+                        for init, tag in [('initial', initial_tag),
+                                          ('update', update_tag)]:
+                            merge(results, f'{name}:{init}',
+                                  cmd + ['-I', init, '-T', tag], tree,
+                                  report_file)
+    finally:
+        os.chdir(scriptdir)
+        rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def report(results):
+    print('%-36s %10s %10s %14s' % ('stage', 'min (s)', 'mean (s)',
+                                    'rss ch. (KiB)'))
+    for stage, runs in results.items():
+        seconds = [r['seconds'] for r in runs]
+        print('%-36s %10.3f %10.3f %14d' % (
+            stage, min(seconds), sum(seconds) / len(seconds),
+            max(r['maxrss_children_kb'] for r in runs)))
+        steps = sorted(set(sum([list(r['steps']) for r in runs], [])))
+        for step in steps:
+            seconds = [r['steps'].get(step, 0) for r in runs]
+            print('    %-32s %10.3f %10.3f' % (
+                step, min(seconds), sum(seconds) / len(seconds)))
+
+
+def script_revision(script):
+    revision = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=dirname(script), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True)
+    if revision.returncode != 0:
+        return None
+    return revision.stdout.strip()
+
+
+def parameters():
+    param = ArgumentParser(description='wlancaf-merge.py benchmark on '
+                                       'synthetic CAF repos.', )
+    param.add_argument('-n', '--runs', type=int, default=3)
+    param.add_argument('-c', '--commits', type=int, default=200,
+                       help='Commits between two tags.')
+    param.add_argument('-t', '--tags', type=int, default=3,
+                       help='Tags per repo, at least 2.')
+    param.add_argument('-f', '--files', type=int, default=200,
+                       help='Files per CAF repo.')
+    param.add_argument('--lines', type=int, default=50,
+                       help='Lines per generated file.')
+    param.add_argument('--kernel-files', dest='kernel_files', type=int,
+                       default=2000,
+                       help='Files in the synthetic kernel tree.')
+    param.add_argument('-W', '--wlan', nargs='+', choices=list(REPOS),
+                       default=['qcacld', 'prima'])
+    param.add_argument('-E', '--engine', nargs='+',
+                       choices=['porcelain', 'plumbing'],
+                       default=['porcelain'])
+    param.add_argument('-F', '--fetch', nargs='+',
+                       choices=['tags', 'tag', 'shallow', 'blobless'],
+                       default=['tag'])
+    param.add_argument('-s', '--script',
+                       default=join(scriptdir, 'wlancaf-merge.py'),
+                       help='wlancaf-merge.py to benchmark, e.g. from '
+                            'another checkout.')
+    param.add_argument('-j', '--json', help='Also write results to this '
+                                            'JSON file.')
+    params = vars(param.parse_args())
+    if params['tags'] < 2:
+        param.error('--tags needs at least 2, initial and update')
+    params['script'] = realpath(params['script'])
+    return params
+
+
+def main():
+    params = parameters()
+    results = run(params)
+    report(results)
+    if params['json'] is not None:
+        params['revision'] = script_revision(params['script'])
+        with open(params['json'], 'w') as output:
+            json.dump({'params': params, 'results': results}, output,
+                      indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,13 @@ from argparse import ArgumentParser
 from subprocess import Popen, PIPE, CalledProcessError
 from multiprocessing import Process
 from os import remove, chdir
-from os.path import exists, isfile, expanduser, join, realpath, isdir, dirname
+from os.path import (exists, isfile, expanduser, join, realpath, isdir,
+                     dirname, basename, relpath, splitext)
 from shutil import copy2 as copy
 from tempfile import mkstemp
 from time import time
+
+from gitsession import GitSession
 start = time()
 date_time = datetime.now().strftime('%Y%m%d-%H%M')
 
@@ -22,14 +25,19 @@ date_time = datetime.now().strftime('%Y%m%d-%H%M')
 def parameters():
     param = ArgumentParser(description='Kernel Build Script.', )
     group = param.add_mutually_exclusive_group()
-    param.add_argument('-b', '--build',
-                       choices=['miui', 'custom'], required=True)
+    param.add_argument('-b', '--build', choices=['miui', 'custom'])
     group.add_argument('--clean-only', dest='clean_only', action='store_true')
     group.add_argument('--clean-and-build', dest='clean_and_build',
                        action='store_true')
     param.add_argument('-c', '--cpuquiet', action='store_true')
-    param.add_argument('-d', '--device',
-                       choices=['mido', 'whyred'], required=True)
+    param.add_argument('--delta', action='store_true',
+                       help='Also create a delta package against the last '
+                            'published build of this variant.')
+    param.add_argument('--apply-delta', dest='apply_delta', nargs=2,
+                       metavar=('BASE_ZIP', 'DELTA_ZIP'),
+                       help='Rebuild the flashable zip from a published '
+                            'zip and a delta package, then exit.')
+    param.add_argument('-d', '--device', choices=['mido', 'whyred'])
     param.add_argument('-o', '--overclock',
                        action='store_true')
     param.add_argument('-r', '--release',
@@ -40,13 +48,18 @@ def parameters():
                        action='store_true')
     param.add_argument('--verbose',
                        action='store_true')
-    param.add_argument('-v', '--version', required=True)
-    param.add_argument('-cc', '--cc', choices=['clang', 'gcc'], required=True)
+    param.add_argument('-w', '--watch', action='store_true',
+                       help='Rebuild and repackage the current source tree '
+                            'whenever it or the AnyKernel template changes.')
+    param.add_argument('-v', '--version')
+    param.add_argument('-cc', '--cc', choices=['clang', 'gcc'])
     params = vars(param.parse_args())
+    apply_delta = params['apply_delta']
     build_type = params['build']
     clean_only = params['clean_only']
     clean_and_build = params['clean_and_build']
     cpuquiet = params['cpuquiet']
+    delta = params['delta']
     device = params['device']
     oc = params['overclock']
     release = params['release']
@@ -54,7 +67,18 @@ def parameters():
     upload = params['upload']
     verbose = params['verbose']
     version = params['version']
+    watch = params['watch']
     cc = params['cc']
+    if apply_delta is None and None in [build_type, device, version, cc]:
+        param.error('-b/--build, -d/--device, -v/--version and -cc/--cc '
+                    'are required')
+    if delta is True or apply_delta is not None:
+        # check now, not after the full zip is already built
+        try:
+            import bsdiff4  # noqa: F401
+        except ImportError:
+            param.error('--delta and --apply-delta need bsdiff4, '
+                        '`pip install bsdiff4`')
     # Check whyred ENV
     if device == 'whyred':
         # Let's fail all of this if depencies are met, because i'm stupid.
@@ -69,10 +93,14 @@ def parameters():
     if version in ['beta' or 'test' or 'personal'] and release is True:
         param.error('version beta|test|personal, '
                     "can't be passed with --release")
+    if watch is True and True in [release, upload]:
+        param.error("-w/--watch can't be passed with --release or --upload")
     return {
+        'apply_delta': apply_delta,
         'type': build_type,
         'clean': [clean_only, clean_and_build],
         'cpuquiet': cpuquiet,
+        'delta': delta,
         'device': device,
         'overclock': oc,
         'release': release,
@@ -80,6 +108,7 @@ def parameters():
         'upload': upload,
         'verbose': verbose,
         'version': version,
+        'watch': watch,
         'cc': cc
     }
 
@@ -94,7 +123,8 @@ def subprocess_run(cmd):
         stderr_val = PIPE
     subproc = Popen(cmd, stdout=stdout_val, stderr=stderr_val,
                     shell=True, universal_newlines=True)
-    subproc.wait()
+    # communicate() waits too, calling wait() first deadlocks once
+    # the PIPE buffers fill up
     talk = subproc.communicate()
     exitCode = subproc.returncode
     if exitCode != 0 and verbose is not True:
@@ -157,8 +187,13 @@ def variables():
         name = name + '-' + device + '-' + version + '-' + date_time
     zipname = name + '.zip'
     finalzip = join(zipdir, zipname)
+    # last published zip, used as base for delta packages
+    basedir = join(zipdir, 'base')
+    if oc is True:
+        basedir = join(basedir, 'OC')
     return {
         'anykernel': anykernel,
+        'basedir': basedir,
         'branch': branch,
         'afh': afh_password,
         'defconfig': defconfig,
@@ -229,15 +264,16 @@ def toolchain():
     }
 
 
-def make():
+def make(defconfig=True):
     outdir = variables()['outdir']
-    defconfig = variables()['defconfig']
     cc = parameters()['cc']
     gcc = toolchain()['gcc']
     gcc32 = toolchain()['gcc32']
     clangopt = toolchain()['clangopt']
-    cmd = f'make ARCH=arm64 O="{outdir}" {defconfig}'
-    subprocess_run(cmd)
+    if defconfig is True:
+        defconfig = variables()['defconfig']
+        cmd = f'make ARCH=arm64 O="{outdir}" {defconfig}'
+        subprocess_run(cmd)
     if cc == 'clang':
         cmd = (f'make ARCH=arm64 O="{outdir}" CROSS_COMPILE="{gcc}" '
                f'CROSS_COMPILE_ARM32="{gcc32}" -j8 {clangopt}')
@@ -281,8 +317,9 @@ def make_wrapper():
     branch = variables()['branch']
     # In-Into sourcedir and change the branch
     chdir(sourcedir)
-    cmd = f'git checkout {branch}'
-    subprocess_run(cmd)
+    git = GitSession(sourcedir)
+    if git.branch() != branch:
+        git.run('checkout', branch)
     if device == 'mido':
         reset()
         if oc is False:
@@ -290,11 +327,8 @@ def make_wrapper():
                 'custom': 'None',  # Haven't have time to rebase PIE
                 'miui': '122cc6988b399885ea8918a790c01662a20e8463'
             }
-            if build_type == 'miui':
-                cmd = f'git revert --no-commit {revert_commit[build_type]}'
-            elif build_type == 'custom':
-                cmd = f'git revert --no-commit {revert_commit[build_type]}'
-            subprocess_run(cmd)
+            git.run('revert', '--no-commit', revert_commit[build_type])
+    git.close()
     try:
         make()
     except CalledProcessError as e:
@@ -392,6 +426,7 @@ def modules():
 def zip_now(zippath):
     from zipfile import ZipFile, ZIP_DEFLATED
     anykernel = variables()['anykernel']
+    delta = parameters()['delta']
     device = parameters()['device']
     image = variables()['image']
     moduledir = variables()['moduledir']
@@ -434,6 +469,8 @@ def zip_now(zippath):
             # also write empty folder too
             for dirnames in directories:
                 ak.write(join(root, dirnames))
+    if delta is True:
+        zip_delta(zippath)
     if exists('banner'):
         # Remove created banner
         remove('banner')
@@ -441,10 +478,158 @@ def zip_now(zippath):
     finalzip_sign(zippath)
 
 
+def delta_targets():
+    anykernel = variables()['anykernel']
+    device = parameters()['device']
+    moduledir = relpath(variables()['moduledir'], anykernel)
+    targets = ['Image.gz-dtb']
+    if device == 'whyred':
+        targets.append(join(moduledir, 'qca_cld3/qca_cld3_wlan.ko'))
+    elif device == 'mido':
+        targets.append(join(moduledir, 'wlan.ko'))
+        targets.append(join(moduledir, 'pronto/pronto_wlan.ko'))
+    return targets
+
+
+def delta_zippath(zippath):
+    return splitext(zippath)[0] + '-delta.zip'
+
+
+def zip_delta(zippath):
+    # bsdiff every entry that changed since the last published build,
+    # manifest.json ties the delta to the base zip it applies on.
+    import hashlib
+    import json
+    import bsdiff4
+    from zipfile import ZipFile, ZIP_DEFLATED
+    basedir = variables()['basedir']
+    basezip = join(basedir, 'base.zip')
+    if not isfile(join(basedir, 'manifest.json')) or not isfile(basezip):
+        print('No published base for this variant, skipping delta...')
+        return None
+    with open(join(basedir, 'manifest.json'), 'r') as m:
+        base = json.load(m)
+    deltazip = delta_zippath(zippath)
+    manifest = {
+        'base': base['zipname'],
+        'base_digest': base['digest'],
+        'target': basename(zippath),
+        'digest': zip_digest(zippath),
+        'files': {},
+        'removed': []
+    }
+    # mido ships wlan.ko twice, same content is stored once
+    stored = {}
+    with ZipFile(zippath, 'r') as nz, ZipFile(basezip, 'r') as bz, \
+            ZipFile(deltazip, 'w', ZIP_DEFLATED) as dz:
+        old = {i.filename: i for i in bz.infolist()
+               if not jar_signature(i.filename)}
+        for info in nz.infolist():
+            target = info.filename
+            if jar_signature(target):
+                continue
+            if target in old and old[target].CRC == info.CRC and \
+                    old[target].file_size == info.file_size:
+                continue
+            data = nz.read(info)
+            digest = hashlib.sha256(data).hexdigest()
+            entry = {'sha256': digest}
+            if not info.is_dir() and digest in stored:
+                entry['action'] = 'copy'
+                entry['source'] = stored[digest]
+            elif target in old and not info.is_dir():
+                base_data = bz.read(target)
+                entry['action'] = 'patch'
+                entry['base_sha256'] = hashlib.sha256(base_data).hexdigest()
+                dz.writestr(target + '.bsdiff',
+                            bsdiff4.diff(base_data, data))
+            else:
+                entry['action'] = 'add'
+                dz.writestr(info, data)
+            if not info.is_dir():
+                stored.setdefault(digest, target)
+            manifest['files'][target] = entry
+        manifest['removed'] = sorted(set(old) - set(nz.namelist()))
+        dz.writestr('manifest.json',
+                    json.dumps(manifest, indent=4, sort_keys=True))
+    print(f'==> Delta against {base["zipname"]} created...')
+    return deltazip
+
+
+def apply_delta(basezip, deltazip):
+    # the other half of zip_delta: base zip + delta = the new build's zip,
+    # checked entry by entry and as a whole against the manifest
+    import hashlib
+    import json
+    import bsdiff4
+    from zipfile import ZipFile, ZIP_DEFLATED
+    with ZipFile(deltazip, 'r') as dz, ZipFile(basezip, 'r') as bz:
+        manifest = json.loads(dz.read('manifest.json'))
+        if zip_digest(basezip) != manifest['base_digest']:
+            print(f'{basename(basezip)} is not the base of this delta, '
+                  f"it was made against {manifest['base']}...")
+            raise ValueError
+        files = manifest['files']
+        rebuilt = {}
+        for target, entry in sorted(files.items()):
+            if entry['action'] == 'patch':
+                old = bz.read(target)
+                if hashlib.sha256(old).hexdigest() != entry['base_sha256']:
+                    print(f'{target} in {basename(basezip)} is not the '
+                          'base of this delta...')
+                    raise ValueError
+                rebuilt[target] = bsdiff4.patch(
+                    old, dz.read(target + '.bsdiff'))
+            elif entry['action'] == 'add':
+                rebuilt[target] = dz.read(target)
+        for target, entry in files.items():
+            if entry['action'] == 'copy':
+                rebuilt[target] = rebuilt[entry['source']]
+        for target, entry in files.items():
+            if hashlib.sha256(rebuilt[target]).hexdigest() != entry['sha256']:
+                print(f'{target}: sha256 mismatch after applying delta...')
+                raise ValueError
+        targetzip = join(dirname(realpath(deltazip)), manifest['target'])
+        with ZipFile(targetzip, 'w', ZIP_DEFLATED) as tz:
+            for info in bz.infolist():
+                # the base zip's jarsigner signature doesn't cover this one
+                if jar_signature(info.filename) or \
+                        info.filename in manifest['removed']:
+                    continue
+                if info.filename in rebuilt:
+                    tz.writestr(info, rebuilt.pop(info.filename))
+                else:
+                    tz.writestr(info, bz.read(info))
+            for target, data in sorted(rebuilt.items()):
+                tz.writestr(target, data)
+    if zip_digest(targetzip) != manifest['digest']:
+        remove(targetzip)
+        print(f'{basename(targetzip)} does not match the build the delta '
+              'was made from...')
+        raise ValueError
+    print(f'==> {basename(targetzip)} rebuilt and verified (unsigned)...')
+    return targetzip
+
+
+def publish_base(zippath):
+    import json
+    basedir = variables()['basedir']
+    if not isdir(basedir):
+        os.makedirs(basedir)
+    copy(zippath, join(basedir, 'base.zip'))
+    manifest = {
+        'zipname': basename(zippath),
+        'digest': zip_digest(zippath)
+    }
+    with open(join(basedir, 'manifest.json'), 'w') as m:
+        json.dump(manifest, m, indent=4, sort_keys=True)
+
+
 # haven't got some idea to sign via python directly without subprocess
 def finalzip_sign(finalzip):
     keystore_password = variables()['keystore']
     scriptdir = variables()['scriptdir']
+    delta = parameters()['delta']
     device = parameters()['device']
     upload = parameters()['upload']
     finalzip = variables()['finalzip']
@@ -456,10 +641,18 @@ def finalzip_sign(finalzip):
                f'jarsigner -keystore {keystore} '
                f'"{finalzip}" stormguard')
         subprocess_run(cmd)
+        # the delta isn't flashable, --apply-delta checks it against
+        # its manifest instead
+        deltazip = delta_zippath(finalzip)
         if upload is True:
             print('==> Uploading...')
             Uploads(device, version, zipname, finalzip)
+            if delta is True and isfile(deltazip):
+                GoogleDrive.Upload(device, version,
+                                   basename(deltazip), deltazip)
             print('==> Upload success...')
+            # this build is now the base for the next delta
+            publish_base(finalzip)
     else:
         raise FileNotFoundError
 
@@ -477,10 +670,37 @@ def md5sum_zip(finalzip):
     return md5
 
 
+def jar_signature(name):
+    '''whether a zip entry is one of the files jarsigner adds'''
+    from fnmatch import fnmatch
+    return name.count('/') == 1 and [
+        p for p in ['META-INF/MANIFEST.MF', 'META-INF/*.SF',
+                    'META-INF/*.RSA', 'META-INF/*.DSA', 'META-INF/*.EC']
+        if fnmatch(name, p)] != []
+
+
+def zip_digest(zippath):
+    # the signed zip's md5 changes with every jarsigner run and its name
+    # with every date_time, names, sizes and CRCs of the entries don't
+    import hashlib
+    from zipfile import ZipFile
+    digest = hashlib.sha256()
+    with ZipFile(zippath, 'r') as z:
+        for info in sorted(z.infolist(), key=lambda i: i.filename):
+            if jar_signature(info.filename):
+                continue
+            digest.update(f'{info.filename}\0{info.CRC:08x}\0'
+                          f'{info.file_size}\n'.encode())
+    return digest.hexdigest()
+
+
 class GoogleDrive(object):
+    service = None
 
     @staticmethod
     def Service():
+        if GoogleDrive.service is not None:
+            return GoogleDrive.service
         from googleapiclient.discovery import build
         from google_auth_oauthlib.flow import InstalledAppFlow
         from google.auth.transport.requests import Request
@@ -505,17 +725,34 @@ class GoogleDrive(object):
                 creds = flow.run_local_server()
             with open(join(scriptdir, 'token.pickle'), 'wb') as token:
                 pickle.dump(creds, token)
-        service = build('drive', 'v3', credentials=creds)
-        return service
+        GoogleDrive.service = build('drive', 'v3', credentials=creds)
+        return GoogleDrive.service
 
     @staticmethod
     def Upload(device, version, filename, filepath):
+        '''(file id, False if the same build was already there)'''
         from googleapiclient.http import MediaFileUpload
         print(' -> Uploading to GoogleDrive...')
-        folder_id = GoogleDrive.CheckFolder(device, version)
+        digest = zip_digest(filepath)
+        # one list for both the version folder and an identical build
+        response = GoogleDrive.Service().files().list(
+            q=(f"trashed=false and (name='{version}' or appProperties has "
+               f"{{ key='content' and value='{digest}' }})"),
+            spaces='drive',
+            fields='files(parents, name, id, appProperties)'
+        ).execute()
+        files = response.get('files', [])
+        folder_id = GoogleDrive.CheckFolder(device, version, files)
+        for uploaded in files:
+            if folder_id in uploaded.get('parents', []) and \
+                    uploaded.get('appProperties', {}).get('content') == digest:
+                print('    identical build already uploaded as '
+                      f"{uploaded.get('name')}, linking to it...")
+                return uploaded.get('id'), False
         file_metadata = {
             'name': filename,
-            'parents': [folder_id]
+            'parents': [folder_id],
+            'appProperties': {'content': digest}
         }
         media = MediaFileUpload(
                 filepath,
@@ -528,10 +765,11 @@ class GoogleDrive(object):
             fields='id'
         ).execute()
         file_id = file.get('id')
-        return file_id
+        return file_id, True
 
     @staticmethod
-    def CheckFolder(device, version):
+    def CheckFolder(device, version, files):
+        # files: Upload's list, the folder is the one named version
         print(' -> Checking folder...')
         parents_id = {
             'cpuquiet': '1i5XRVcO3Q8y8OFAOxXU-UWGWmQJiKo2u',
@@ -547,18 +785,9 @@ class GoogleDrive(object):
             'parents': [parents_id],
             'mimeType': 'application/vnd.google-apps.folder'
         }
-        page_token = None
-        response = GoogleDrive.Service().files().list(
-            q=f"name='{version}'",
-            spaces='drive',
-            fields=(
-                'nextPageToken, '
-                'files(parents, name, id)'
-            ),
-            pageToken=page_token
-        ).execute()
+        files = [f for f in files if f.get('name') == version]
         try:
-            is_exists = response.get('files', [])[0]
+            is_exists = files[0]
         except IndexError:
             print('    folder not exists, creating now...')
             folder = GoogleDrive.Service().files().create(
@@ -575,13 +804,24 @@ class GoogleDrive(object):
             else:
                 print('error, can not find existing folder...')
                 raise ValueError
-        page_token = response.get('nextPageToken', None)
         return folder_id
 
 
 def afh_upload(filename, filepath):
+    import json
     from ftplib import FTP
     password = variables()['afh']
+    scriptdir = variables()['scriptdir']
+    # AFH doesn't expose checksums, keep our own ledger of uploads
+    ledger_path = join(scriptdir, 'afh-uploads.json')
+    ledger = {}
+    if isfile(ledger_path):
+        with open(ledger_path, 'r') as ledger_file:
+            ledger = json.load(ledger_file)
+    digest = zip_digest(filepath)
+    if digest in ledger.values():
+        print(' -> Identical build already uploaded to AFH, skipping...')
+        return
     with FTP('uploads.androidfilehost.com') as ftp:
         ftp.login('adek', password)
         try:
@@ -590,6 +830,9 @@ def afh_upload(filename, filepath):
             ftp.delete(filename)
             print('!!! deleting uploaded file... !!!')
             raise
+    ledger[filename] = digest
+    with open(ledger_path, 'w') as ledger_file:
+        json.dump(ledger, ledger_file, indent=4, sort_keys=True)
 
 
 def Uploads(device, version, zipname, finalzip):
@@ -600,10 +843,13 @@ def Uploads(device, version, zipname, finalzip):
     verbose = parameters()['verbose']
     if isfile(finalzip):
         if cpuquiet is True:
-            file_id = GoogleDrive.Upload(device, version, zipname, finalzip)
+            file_id, published = GoogleDrive.Upload(device, version,
+                                                    zipname, finalzip)
             download_url = ('https://drive.google.com/'
                             f'uc?id={file_id}&export=download')
-            if telegram is True:
+            if telegram is True and published is False:
+                print(' -> Nothing new published, not posting to Telegram...')
+            elif telegram is True:
                 from requests import post
                 md5 = md5sum_zip(finalzip)
                 tg_chat = '-1001354431412'
@@ -652,14 +898,95 @@ def reset():
     verbose = parameters()['verbose']
     if device == 'mido':
         if verbose is True:
-            cmd = 'git reset -q --hard'
+            GitSession().run('reset', '-q', '--hard')
         else:
-            cmd = 'git reset --hard'
-        subprocess_run(cmd)
+            GitSession().run('reset', '--hard')
     else:
         return
 
 
+def artifacts_state():
+    image = variables()['image']
+    outmodule = variables()['outmodule']
+    state = []
+    for artifact in [image, outmodule]:
+        if isfile(artifact):
+            stat = os.stat(artifact)
+            state.append((artifact, stat.st_size, stat.st_mtime_ns))
+    return state
+
+
+def watch():
+    # needs inotifywait from inotify-tools
+    from select import select
+    from shutil import which
+    anykernel = variables()['anykernel']
+    defconfig = variables()['defconfig']
+    finalzip = variables()['finalzip']
+    sourcedir = variables()['sourcedir']
+    debounce = 0.5
+    if which('inotifywait') is None:
+        print('inotifywait not found, install inotify-tools...')
+        raise FileNotFoundError
+    # unlike make_wrapper, build the tree as it is: no checkout,
+    # revert or reset which would throw away the changes being tested
+    chdir(sourcedir)
+    # files zip_now writes into the template must not trigger a rebuild
+    generated = [join(anykernel, t) for t in delta_targets()]
+    generated.append(join(anykernel, 'banner'))
+    generated = '|'.join([g.replace('.', r'\.') for g in generated])
+    cmd = ['inotifywait', '-m', '-r', '-q',
+           '-e', 'close_write,create,delete,move',
+           '--format', '%w%f',
+           '--exclude', rf'(/\.git/|\.swp$|~$|^({generated})$)',
+           sourcedir, anykernel]
+    inotify = Popen(cmd, stdout=PIPE)
+    events = inotify.stdout.fileno()
+    rebuild = True
+    repackage = True
+    reconfig = not isfile(join(variables()['outdir'], '.config'))
+    packaged = None
+    try:
+        while True:
+            built = True
+            if rebuild is True:
+                print('==> Building...')
+                try:
+                    make(defconfig=reconfig)
+                except CalledProcessError:
+                    print('Failed to make kernel image...')
+                    built = False
+            if built is True and (repackage is True or
+                                  artifacts_state() != packaged):
+                print('==> Packaging...')
+                zip_now(finalzip)
+                packaged = artifacts_state()
+                print(f'==> {basename(finalzip)} is ready...')
+            print('==> Waiting for changes...')
+            # block for the first change, then collect until it goes quiet
+            data = os.read(events, 65536)
+            while data and select([events], [], [], debounce)[0]:
+                chunk = os.read(events, 65536)
+                if not chunk:
+                    break
+                data += chunk
+            if not data:
+                print('inotifywait exited...')
+                break
+            rebuild = repackage = reconfig = False
+            for path in data.decode().splitlines():
+                if path.startswith(anykernel + '/'):
+                    repackage = True
+                else:
+                    rebuild = True
+                    if path.endswith(f'/configs/{defconfig}'):
+                        reconfig = True
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.terminate()
+
+
 def main():
     if not exists('Makefile'):
         print('Please run this script inside kernel tree')
@@ -667,12 +994,17 @@ def main():
     if isdir('Makefile'):
         print('Makefile is a directory...')
         raise IsADirectoryError
+    if parameters()['watch'] is True:
+        watch()
+        return
     P = Process(target=make_wrapper, name='make_kernel')
     P.start()
     P.join()
 
 
 if __name__ == '__main__':
-    parameters()
+    if parameters()['apply_delta'] is not None:
+        apply_delta(*parameters()['apply_delta'])
+        sys.exit(0)
     make_clean()
     main()
@@ -0,0 +1,214 @@
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Copyright (C) 2019 Adek Maulana
+
+'''
+Shared git access for build-kernel.py and wlancaf-merge.py.
+
+Commands run without a shell, and read queries go through long-lived
+`git cat-file --batch-check` / `--batch` processes instead of one fork
+per lookup.
+'''
+
+from __future__ import print_function
+
+import binascii
+import threading
+from os.path import isabs, join
+from subprocess import PIPE, Popen, CalledProcessError
+
+
+class GitSession(object):
+    version_cache = None
+
+    def __init__(self, cwd=None):
+        self.cwd = cwd
+        self.lock = threading.Lock()
+        self.check = None
+        self.batch = None
+        self.mktree_batch = None
+        self.gitdir = None
+
+    def run(self, *args):
+        cmd = ['git'] + list(args)
+        subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.cwd,
+                        universal_newlines=True)
+        talk = subproc.communicate()
+        if subproc.returncode != 0:
+            print('An error was detected while running the subprocess:\n'
+                  'exit code: %d\n'
+                  'stdout: %s\n'
+                  'stderr: %s' % (subproc.returncode, talk[0], talk[1]))
+            raise CalledProcessError(subproc.returncode, ' '.join(cmd))
+        return talk[0]
+
+    def version(self):
+        # same binary for every session, parse `git version 2.39.5` once
+        if GitSession.version_cache is None:
+            version = self.run('--version').split()[2].split('.')
+            GitSession.version_cache = (int(version[0]), int(version[1]))
+        return GitSession.version_cache
+
+    def git_dir(self):
+        if self.gitdir is None:
+            gitdir = self.run('rev-parse', '--git-dir').strip('\n')
+            if not isabs(gitdir) and self.cwd is not None:
+                gitdir = join(self.cwd, gitdir)
+            self.gitdir = gitdir
+        return self.gitdir
+
+    def branch(self):
+        # what `rev-parse --abbrev-ref HEAD` says, without a fork
+        with open(join(self.git_dir(), 'HEAD'), 'r') as head:
+            head = head.read().strip()
+        if head.startswith('ref: refs/heads/'):
+            return head[len('ref: refs/heads/'):]
+        return 'HEAD'
+
+    def cat_file(self, mode):
+        return Popen(['git', 'cat-file', mode], stdin=PIPE, stdout=PIPE,
+                     cwd=self.cwd)
+
+    def resolve(self, rev):
+        '''object name of rev, or None if it doesn't exist'''
+        with self.lock:
+            if self.check is None:
+                self.check = self.cat_file('--batch-check')
+            self.check.stdin.write(rev.encode() + b'\n')
+            self.check.stdin.flush()
+            line = self.check.stdout.readline().decode().split()
+        if len(line) != 3:
+            return None
+        return line[0]
+
+    def read(self, rev):
+        '''(type, content) of rev, or None if it doesn't exist'''
+        with self.lock:
+            if self.batch is None:
+                self.batch = self.cat_file('--batch')
+            self.batch.stdin.write(rev.encode() + b'\n')
+            self.batch.stdin.flush()
+            header = self.batch.stdout.readline().decode().split()
+            if len(header) != 3:
+                return None
+            content = self.batch.stdout.read(int(header[2]))
+            self.batch.stdout.read(1)
+        return header[1], content
+
+    def ls_tree(self, tree):
+        '''[(mode, type, sha, name)] parsed from the raw tree object'''
+        # names stay bytes, they don't have to be valid utf-8
+        entries = []
+        if tree is None:
+            return entries
+        content = self.read(tree)[1]
+        position = 0
+        while position < len(content):
+            space = content.index(b' ', position)
+            nul = content.index(b'\0', space)
+            mode = content[position:space].decode()
+            name = content[space + 1:nul]
+            sha = binascii.hexlify(content[nul + 1:nul + 21]).decode()
+            if mode == '40000':
+                kind = 'tree'
+            elif mode == '160000':
+                kind = 'commit'
+            else:
+                kind = 'blob'
+            entries.append((mode, kind, sha, name))
+            position = nul + 21
+        return entries
+
+    def mktree(self, entries):
+        with self.lock:
+            if self.mktree_batch is None:
+                self.mktree_batch = Popen(['git', 'mktree', '--batch'],
+                                          stdin=PIPE, stdout=PIPE,
+                                          cwd=self.cwd)
+            data = b''.join([('%s %s %s\t' % entry[:3]).encode() +
+                             entry[3] + b'\n' for entry in entries])
+            self.mktree_batch.stdin.write(data + b'\n')
+            self.mktree_batch.stdin.flush()
+            return self.mktree_batch.stdout.readline().decode().strip()
+
+    def graft(self, tree, prefix, sha, mode='040000', kind='tree'):
+        '''
+        tree with the entry at prefix replaced by sha (removed if sha is
+        None), only the trees along prefix are rewritten
+        '''
+        parts = prefix.strip('/').encode().split(b'/')
+        entries = self.ls_tree(tree)
+        existing = [e for e in entries if e[3] == parts[0]]
+        entries = [e for e in entries if e[3] != parts[0]]
+        if len(parts) > 1:
+            subtree = None
+            if existing and existing[0][1] == 'tree':
+                subtree = existing[0][2]
+            sha = self.graft(subtree, b'/'.join(parts[1:]).decode(), sha,
+                             mode, kind)
+            mode, kind = '040000', 'tree'
+        if sha is not None:
+            entries.append((mode, kind, sha, parts[0]))
+        if not entries:
+            return None
+        return self.mktree(entries)
+
+    def hash_object(self, data):
+        subproc = Popen(['git', 'hash-object', '-w', '--stdin'], stdin=PIPE,
+                        stdout=PIPE, cwd=self.cwd)
+        talk = subproc.communicate(data)
+        if subproc.returncode != 0:
+            raise CalledProcessError(subproc.returncode, 'git hash-object')
+        return talk[0].decode().strip()
+
+    def commit_tree(self, tree, parents=(), message='', sign=False):
+        args = ['commit-tree', tree]
+        for parent in parents:
+            args += ['-p', parent]
+        if sign is True:
+            args.append('-S')
+        subproc = Popen(['git'] + args, stdin=PIPE, stdout=PIPE,
+                        stderr=PIPE, cwd=self.cwd, universal_newlines=True)
+        talk = subproc.communicate(message)
+        if subproc.returncode != 0:
+            print('An error was detected while running the subprocess:\n'
+                  'exit code: %d\n'
+                  'stderr: %s' % (subproc.returncode, talk[1]))
+            raise CalledProcessError(subproc.returncode, 'git commit-tree')
+        return talk[0].strip()
+
+    def merge_tree(self, ours, theirs):
+        '''
+        (tree, conflicted paths) of merging two commits, entirely in the
+        object database, needs git 2.38
+        '''
+        cmd = ['git', 'merge-tree', '--write-tree', '--name-only',
+               '--no-messages', ours, theirs]
+        subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.cwd,
+                        universal_newlines=True)
+        talk = subproc.communicate()
+        if subproc.returncode not in [0, 1]:
+            print('An error was detected while running the subprocess:\n'
+                  'exit code: %d\n'
+                  'stderr: %s' % (subproc.returncode, talk[1]))
+            raise CalledProcessError(subproc.returncode, ' '.join(cmd))
+        lines = talk[0].split('\n')
+        return lines[0], [line for line in lines[1:] if line]
+
+    def log(self, revs, fmt='%s', limit=None, options=(), paths=()):
+        '''one `git log` for the subjects of revs, count is just len()'''
+        args = ['log', '--pretty=format:%s' % fmt] + list(options)
+        if limit is not None:
+            args.append('-%d' % limit)
+        output = self.run(*(args + list(revs) + ['--'] + list(paths)))
+        if not output:
+            return []
+        return output.split('\n')
+
+    def close(self):
+        for proc in [self.check, self.batch, self.mktree_batch]:
+            if proc is not None:
+                proc.stdin.close()
+                proc.wait()
+        self.check = self.batch = self.mktree_batch = None
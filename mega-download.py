@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Copyright (C) 2019 Adek Maulana
+
+'''
+Download and decrypt MEGA links with parallel range requests.
+
+shell/megadirect works out the direct URL, file name, size, key and iv.
+The file is preallocated, every segment is fetched with a range request
+and decrypted on its own, since AES-CTR's counter for a byte offset is
+just iv + offset / 16, then written in place.  Finished segments are
+kept in a .state file next to the .part file, so an interrupted download
+resumes with a fresh link where it stopped.
+'''
+
+import json
+import os
+import subprocess
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, dirname, exists, join, realpath
+from urllib.request import Request, urlopen
+
+try:
+    from cryptography.hazmat.primitives.ciphers import (Cipher, algorithms,
+                                                        modes)
+except ImportError:
+    # openssl is there anyway, megadirect needs it
+    Cipher = None
+
+scriptdir = dirname(realpath(__file__))
+megadirect = join(scriptdir, 'shell/megadirect')
+
+# multiple of the 16 byte AES block, every chunk starts on a block
+CHUNK = 1 << 20
+
+
+def ctr_decrypt(key, iv, offset, data):
+    counter = (int.from_bytes(iv, 'big') + offset // 16) % (1 << 128)
+    counter = counter.to_bytes(16, 'big')
+    if Cipher is not None:
+        decryptor = Cipher(algorithms.AES(key), modes.CTR(counter)).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+    openssl = subprocess.run(['openssl', 'enc', '-d', '-aes-128-ctr',
+                              '-K', key.hex(), '-iv', counter.hex()],
+                             input=data, stdout=subprocess.PIPE, check=True)
+    return openssl.stdout
+
+
+def resolve(link):
+    # {"file_name", "file_size", "url", "raw_hex" (iv), "hex" (key)}
+    output = subprocess.run([megadirect, link], stdout=subprocess.PIPE,
+                            check=True, universal_newlines=True).stdout
+    info = json.loads(output)
+    return {'name': info['file_name'], 'size': int(info['file_size']),
+            'url': info['url'], 'key': info['hex'], 'iv': info['raw_hex']}
+
+
+class Download(object):
+    def __init__(self, target, url, size, key, iv, segment):
+        self.target = target
+        self.part = target + '.part'
+        self.state_file = target + '.state'
+        self.url = url
+        self.size = size
+        self.key = bytes.fromhex(key)
+        self.iv = bytes.fromhex(iv)
+        self.segment = segment
+        self.count = (size + segment - 1) // segment
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def identity(self):
+        # MEGA links expire, the same file is the same key, iv and size
+        return {'key': self.key.hex(), 'iv': self.iv.hex(),
+                'size': self.size, 'segment': self.segment}
+
+    def load_state(self):
+        if not exists(self.state_file) or not exists(self.part):
+            return
+        with open(self.state_file, 'r') as state:
+            state = json.load(state)
+        if state['identity'] != self.identity():
+            print(f' -> {self.state_file} is for another file, '
+                  'starting over...')
+            return
+        self.done = set(state['done'])
+
+    def save_state(self):
+        # called with self.lock held
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as state:
+            json.dump({'identity': self.identity(),
+                       'done': sorted(self.done)}, state)
+        os.replace(tmp, self.state_file)
+
+    def fetch(self, fd, index):
+        start = index * self.segment
+        end = min(start + self.segment, self.size) - 1
+        request = Request(self.url, headers={'Range': f'bytes={start}-{end}'})
+        offset = start
+        with urlopen(request) as response:
+            if response.status != 206:
+                raise IOError(f'{self.url}: no range support')
+            while offset <= end:
+                data = response.read(min(CHUNK, end - offset + 1))
+                if not data:
+                    raise IOError(f'{self.url}: short read at {offset}')
+                # whole blocks only, so the next chunk's counter lines up
+                while len(data) % 16 and offset + len(data) <= end:
+                    more = response.read(16 - len(data) % 16)
+                    if not more:
+                        break
+                    data += more
+                os.pwrite(fd, ctr_decrypt(self.key, self.iv, offset, data),
+                          offset)
+                offset += len(data)
+        with self.lock:
+            self.done.add(index)
+            self.save_state()
+
+    def run(self, jobs):
+        self.load_state()
+        pending = [i for i in range(self.count) if i not in self.done]
+        if self.done:
+            print(f' -> Resuming, {len(self.done)}/{self.count} segments '
+                  'already there...')
+        fd = os.open(self.part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                if hasattr(os, 'posix_fallocate') and self.size:
+                    os.posix_fallocate(fd, 0, self.size)
+                os.ftruncate(fd, self.size)
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(self.fetch, fd, i) for i in pending]
+                for future in futures:
+                    future.result()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(self.part, self.target)
+        if exists(self.state_file):
+            os.remove(self.state_file)
+        print(f' -> {basename(self.target)} downloaded and decrypted...')
+
+
+def parameters():
+    param = ArgumentParser(description='MEGA segmented downloader.', )
+    param.add_argument('link', nargs='?',
+                       help='https://mega.nz/#!id!key link, resolved with '
+                            'shell/megadirect.')
+    param.add_argument('--url', help='Direct URL, skips megadirect.')
+    param.add_argument('--key', help='AES key in hex, with --url.')
+    param.add_argument('--iv', help='AES-CTR iv in hex, with --url.')
+    param.add_argument('--size', type=int, help='File size, with --url.')
+    param.add_argument('-o', '--output', help='Output file, defaults to '
+                                              'the MEGA file name.')
+    param.add_argument('-j', '--jobs', type=int, default=4,
+                       help='Parallel range requests.')
+    param.add_argument('-s', '--segment', type=int, default=8 << 20,
+                       help='Segment size, a multiple of 16.')
+    params = vars(param.parse_args())
+    if params['link'] is None and None in [params['url'], params['key'],
+                                           params['iv'], params['size']]:
+        param.error('give a MEGA link, or --url, --key, --iv and --size')
+    if params['link'] is None and params['output'] is None:
+        param.error('--url needs -o/--output')
+    if params['segment'] <= 0 or params['segment'] % 16:
+        param.error('--segment must be a positive multiple of 16')
+    return params
+
+
+def main():
+    params = parameters()
+    if params['link'] is not None:
+        print(' -> Resolving link...')
+        info = resolve(params['link'])
+    else:
+        info = {'name': params['output'], 'size': params['size'],
+                'url': params['url'], 'key': params['key'],
+                'iv': params['iv']}
+    target = params['output'] or info['name']
+    print(f' -> Fetching {info["name"]} ({info["size"]} bytes)...')
+    Download(target, info['url'], info['size'], info['key'], info['iv'],
+             params['segment']).run(params['jobs'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Copyright (C) 2019 Adek Maulana
+
+'''
+Provision the toolchains build-kernel.py expects in ~/kernel/toolchain.
+
+Every toolchain version lives in .versions/<name>/<version>, and
+~/kernel/toolchain/<name> is a symlink to the active one, so the paths
+build-kernel.py uses never change.  Archives are fetched with parallel
+range requests and fed straight into tarfile while hashing, nothing is
+written besides the extracted toolchain itself.
+'''
+
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os.path import (dirname, expanduser, isabs, isdir, islink, join,
+                     lexists, realpath)
+from shutil import rmtree
+from urllib.request import Request, urlopen
+
+tcdir = join(expanduser('~'), 'kernel/toolchain')
+versions = join(tcdir, '.versions')
+
+
+class RangeReader(io.RawIOBase):
+    '''
+    Sequential file object over a URL, backed by worker threads fetching
+    the segments ahead of the reader with range requests.  At most
+    `window` segments are held in memory.
+    '''
+
+    def __init__(self, url, length, jobs=4, segment=8 << 20, window=None):
+        self.url = url
+        self.length = length
+        self.segment = segment
+        self.count = (length + segment - 1) // segment
+        self.window = window or jobs * 2
+        self.fetched = {}
+        self.error = None
+        self.next_fetch = 0
+        self.current = 0
+        self.buffer = b''
+        self.lock = threading.Condition()
+        self.workers = [threading.Thread(target=self.worker, daemon=True)
+                        for _ in range(min(jobs, self.count))]
+        for worker in self.workers:
+            worker.start()
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while (self.next_fetch < self.count and
+                       self.next_fetch >= self.current + self.window and
+                       self.error is None):
+                    self.lock.wait()
+                if self.next_fetch >= self.count or self.error is not None:
+                    return
+                index = self.next_fetch
+                self.next_fetch += 1
+            start = index * self.segment
+            end = min(start + self.segment, self.length) - 1
+            try:
+                request = Request(self.url,
+                                  headers={'Range': f'bytes={start}-{end}'})
+                with urlopen(request) as response:
+                    if response.status != 206:
+                        raise IOError(f'{self.url}: no range support')
+                    data = response.read()
+                if len(data) != end - start + 1:
+                    raise IOError(f'{self.url}: short read at {start}')
+            except Exception as e:
+                with self.lock:
+                    self.error = e
+                    self.lock.notify_all()
+                return
+            with self.lock:
+                self.fetched[index] = data
+                self.lock.notify_all()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            if self.current >= self.count:
+                return 0
+            with self.lock:
+                while (self.current not in self.fetched and
+                       self.error is None):
+                    self.lock.wait()
+                if self.error is not None:
+                    raise self.error
+                self.buffer = self.fetched.pop(self.current)
+                self.current += 1
+                self.lock.notify_all()
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        with self.lock:
+            if self.error is None:
+                self.error = IOError('closed')
+            self.lock.notify_all()
+        super().close()
+
+
+class HashingReader(io.RawIOBase):
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = self.raw.readinto(b)
+        self.sha256.update(memoryview(b)[:size])
+        return size
+
+    def drain(self):
+        # tarfile stops at the end-of-archive marker, hash the padding too
+        while self.read(1 << 20):
+            pass
+        return self.sha256.hexdigest()
+
+
+def open_url(url, jobs):
+    with urlopen(Request(url, method='HEAD')) as response:
+        length = response.headers.get('Content-Length')
+        ranges = response.headers.get('Accept-Ranges', 'none')
+    if jobs > 1 and length is not None and ranges == 'bytes':
+        return RangeReader(url, int(length), jobs=jobs)
+    print(f'    {url}: no range support, using a single stream...')
+    return urlopen(url)
+
+
+def safe_member(member, path):
+    # what the 'data' filter refuses, for Pythons without it: members
+    # are written before the sha256 is known
+    root = realpath(path)
+
+    def inside(name):
+        target = realpath(join(root, name))
+        return target == root or target.startswith(root + os.sep)
+
+    if isabs(member.name) or not inside(member.name):
+        return False
+    if member.issym():
+        return not isabs(member.linkname) and inside(
+            join(dirname(member.name), member.linkname))
+    if member.islnk():
+        return not isabs(member.linkname) and inside(member.linkname)
+    return member.isfile() or member.isdir()
+
+
+def extract(stream, path):
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(path, filter='data')
+            return
+        for member in tar:
+            if not safe_member(member, path):
+                raise ValueError(f'{member.name}: leaves {path} or is not '
+                                 'a file, directory or link')
+            # no setuid bits or group/other write, like the filter
+            member.mode &= 0o755
+            tar.extract(member, path)
+
+
+def install(toolchain, jobs):
+    name = toolchain['name']
+    version = toolchain['version']
+    path = join(versions, name, version)
+    if isdir(path):
+        print(f' -> {name} {version} already installed...')
+        return path
+    print(f' -> Fetching {name} {version}...')
+    partial = join(versions, name, f'.{version}.partial')
+    rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    raw = open_url(toolchain['url'], jobs)
+    stream = HashingReader(raw)
+    try:
+        extract(io.BufferedReader(stream, 1 << 20), partial)
+        digest = stream.drain()
+    except BaseException:
+        rmtree(partial, ignore_errors=True)
+        raise
+    finally:
+        raw.close()
+    if digest != toolchain['sha256']:
+        rmtree(partial, ignore_errors=True)
+        raise ValueError(f'{name} {version}: sha256 mismatch, '
+                         f'expected {toolchain["sha256"]}, got {digest}')
+    os.rename(partial, path)
+    print(f' -> {name} {version} verified and installed...')
+    return path
+
+
+def activate(name, version):
+    link = join(tcdir, name)
+    target = join('.versions', name, version)
+    if not isdir(join(tcdir, target)):
+        print(f'{name} {version} is not installed...')
+        raise FileNotFoundError
+    if lexists(link) and not islink(link):
+        print(f'{link} is not managed by toolchain-manager, '
+              'move it away first...')
+        raise IsADirectoryError
+    # rename() over the old symlink is atomic, builds never see no toolchain
+    tmp = join(tcdir, f'.{name}.tmp')
+    if lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+    print(f' -> {name} is now {version}...')
+
+
+def active(name):
+    link = join(tcdir, name)
+    if islink(link):
+        return os.readlink(link).split(os.sep)[-1]
+    return None
+
+
+def load_manifest(manifest):
+    with open(manifest, 'r') as m:
+        toolchains = json.load(m)['toolchains']
+    for toolchain in toolchains:
+        for key in ['name', 'version', 'url', 'sha256']:
+            if key not in toolchain:
+                print(f'manifest entry {toolchain} has no {key}...')
+                raise KeyError(key)
+    return toolchains
+
+
+def parameters():
+    param = ArgumentParser(description='Kernel toolchain manager.', )
+    param.add_argument('-m', '--manifest', default='toolchains.json',
+                       help='JSON manifest of toolchains, '
+                            '{"toolchains": [{name, version, url, sha256}]}.')
+    param.add_argument('-j', '--jobs', type=int, default=4,
+                       help='Parallel range requests per archive.')
+    command = param.add_subparsers(dest='command', required=True)
+    sync = command.add_parser('sync', help='Install and activate the '
+                                           'manifest toolchains.')
+    sync.add_argument('names', nargs='*')
+    use = command.add_parser('use', help='Switch the active version.')
+    use.add_argument('name')
+    use.add_argument('version')
+    command.add_parser('list', help='Show installed versions.')
+    remove = command.add_parser('remove', help='Remove an inactive '
+                                               'version.')
+    remove.add_argument('name')
+    remove.add_argument('version')
+    return vars(param.parse_args())
+
+
+def main():
+    params = parameters()
+    command = params['command']
+    if command == 'sync':
+        toolchains = load_manifest(params['manifest'])
+        if params['names']:
+            toolchains = [t for t in toolchains
+                          if t['name'] in params['names']]
+        with ThreadPoolExecutor(max_workers=len(toolchains) or 1) as pool:
+            futures = [pool.submit(install, t, params['jobs'])
+                       for t in toolchains]
+            for future in futures:
+                future.result()
+        for toolchain in toolchains:
+            activate(toolchain['name'], toolchain['version'])
+    elif command == 'use':
+        activate(params['name'], params['version'])
+    elif command == 'list':
+        if not isdir(versions):
+            return
+        for name in sorted(os.listdir(versions)):
+            for version in sorted(os.listdir(join(versions, name))):
+                if version.startswith('.'):
+                    continue
+                mark = '*' if active(name) == version else ' '
+                print(f'{mark} {name} {version}')
+    elif command == 'remove':
+        if active(params['name']) == params['version']:
+            print(f'{params["name"]} {params["version"]} is active, '
+                  'switch to another version first...')
+            sys.exit(1)
+        rmtree(join(versions, params['name'], params['version']))
+
+
+if __name__ == '__main__':
+    main()
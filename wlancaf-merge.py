@@ -10,12 +10,25 @@ Version: 1.1
 
 from __future__ import print_function
 
+import atexit
+import json
 import os
+import re
 import sys
+import threading
+import time
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from os import listdir
-from os.path import isdir, exists, join
-from subprocess import PIPE, Popen, CalledProcessError
+from os.path import (isdir, exists, expanduser, getsize, islink, join,
+                     abspath, realpath)
+from subprocess import PIPE, STDOUT, Popen, CalledProcessError
+from tempfile import gettempdir
+
+from gitsession import GitSession
+
+# per process, batch mode runs several merges at once
+MERGE_MESSAGE = join(gettempdir(), 'merge-message-%d' % os.getpid())
 
 
 def subprocess_run(cmd):
@@ -28,8 +41,8 @@ def subprocess_run(cmd):
               'exit code: %d\n'
               'stdout: %s\n'
               'stderr: %s' % (exitCode, talk[0], talk[1]))
-        if exists('/tmp/merge-message'):
-            os.remove('/tmp/merge-message')
+        if exists(MERGE_MESSAGE):
+            os.remove(MERGE_MESSAGE)
         if 'CONFLICT' in talk[0]:
             print('Merge needs manual intervention!.')
             print('Resolve conflict(s) and `git commit` if you are done.')
@@ -39,57 +52,229 @@ def subprocess_run(cmd):
     return talk
 
 
+def succeeded(cmd):
+    subproc = Popen(cmd, stdout=PIPE, stderr=PIPE,
+                    shell=True, universal_newlines=True)
+    subproc.communicate()
+    return subproc.returncode == 0
+
+
+sessions = {}
+
+
+def git(cwd=None):
+    # one session per repository, batch mode moves between kernel trees
+    cwd = abspath(cwd or os.getcwd())
+    if cwd not in sessions:
+        sessions[cwd] = GitSession(cwd)
+    return sessions[cwd]
+
+
+def close_git(cwd=None):
+    # reap the session's cat-file and mktree processes
+    session = sessions.pop(abspath(cwd or os.getcwd()), None)
+    if session is not None:
+        session.close()
+
+
+def close_sessions():
+    for cwd in list(sessions):
+        close_git(cwd)
+
+
+atexit.register(close_sessions)
+
+
+def git_version():
+    return git().version()
+
+
 def git_env():
-    cmd = 'git --version | cut -d " " -f3 | head -n1 | tr -d "\n"'
-    talk = subprocess_run(cmd)
-    version = talk[0].strip().split('.')
-    git_version = (int(version[0]), int(version[1]))
-    if git_version >= (2, 9):
+    if git_version() >= (2, 9):
         extra_cmd = '--allow-unrelated-histories'
     else:
         extra_cmd = ''
     return extra_cmd
 
 
+# objects and bytes received for --report, small fetches would otherwise
+# be unpacked without progress
+FETCH_PROGRESS = 'git -c fetch.unpackLimit=1 fetch --progress'
+
+# --report, {repos: {steps: {step: seconds}, objects, bytes, commits, files}}
+report = {}
+report_lock = threading.Lock()
+
+
+def report_add(repos, key, value, step=None):
+    if report_file is None:
+        return
+    with report_lock:
+        entry = report.setdefault(repos or '*', {'steps': {}})
+        if step is not None:
+            entry = entry['steps']
+            key = step
+        entry[key] = entry.get(key, 0) + value
+
+
+@contextmanager
+def timed(step, repos=None):
+    start = time.time()
+    try:
+        yield
+    finally:
+        report_add(repos, None, time.time() - start, step)
+
+
+def report_fetched(repos, stderr):
+    # last `Receiving objects: 100% (N/N), 1.20 MiB | ...` of a --progress
+    # fetch, nothing received prints nothing
+    units = {'bytes': 1, 'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30}
+    received = re.findall(r'Receiving objects: 100% \((\d+)/\d+\)'
+                          r'(?:, ([\d.]+) (bytes|KiB|MiB|GiB))?', stderr)
+    if not received:
+        return
+    objects, size, unit = received[-1]
+    report_add(repos, 'objects', int(objects))
+    if size:
+        report_add(repos, 'bytes', int(float(size) * units[unit]))
+
+
+def report_files(repos, old, new):
+    if report_file is None:
+        return
+    files = git().run('diff', '--name-only', old, new).split('\n')
+    report_add(repos, 'files', len([f for f in files if f]))
+
+
+def write_report(started):
+    data = {'wlan': wlan_type, 'init': merge_type, 'tag': tag,
+            'engine': engine, 'fetch': fetch_type, 'mirror': use_mirror,
+            'git': '.'.join([str(v) for v in git_version()]),
+            'python': '.'.join([str(v) for v in sys.version_info[:3]]),
+            'started': started, 'total': time.time() - started,
+            'repos': report}
+    with open(report_file, 'w') as report_json:
+        json.dump(data, report_json, indent=4, sort_keys=True)
+    print('Report written to %s' % report_file)
+
+
 def parameters():
-    global wlan_type, merge_type, tag
+    global wlan_type, merge_type, tag, fetch_type, depth, caf_url
+    global use_mirror, cache_dir, cache_action, batch, jobs, predict_only
+    global engine, worktree, combine, report_file
     param = ArgumentParser(description='WLAN-CAF driver updater/initial '
                                        'merge into android kernel source.', )
     param.add_argument('-W', '--wlan', choices=['qcacld', 'prima'],
-                       help='Your wlan driver type, either qcacld or prima.',
-                       required=True)
+                       help='Your wlan driver type, either qcacld or prima.')
     param.add_argument('-I', '--init', choices=['update', 'initial'],
-                       help='Choose wether to update or initial merge.',
-                       required=True)
-    param.add_argument('-T', '--tag', help='Your current/target CAF TAG.',
-                       required=True)
+                       help='Choose wether to update or initial merge.')
+    param.add_argument('-T', '--tag', help='Your current/target CAF TAG.')
+    param.add_argument('-U', '--url',
+                       default=('https://source.codeaurora.org/quic/la/'
+                                'platform/vendor/qcom-opensource/wlan'),
+                       help='Base URL of the CAF WLAN repos.')
+    param.add_argument('-F', '--fetch',
+                       choices=['tags', 'tag', 'shallow', 'blobless'],
+                       default='tags',
+                       help='How to fetch CAF repos: every tag (default), '
+                            'only the needed tags, shallow (--depth on '
+                            'initial) or blobless (partial clone).')
+    param.add_argument('--depth', type=int, default=50,
+                       help='History depth for --fetch shallow, also used '
+                            'as the step when deepening.')
+    param.add_argument('-M', '--mirror', action='store_true',
+                       help='Fetch through a local mirror cache shared by '
+                            'all kernel trees.')
+    param.add_argument('--cache-dir', dest='cache_dir',
+                       default=join(expanduser('~'), '.cache/wlancaf'),
+                       help='Where the mirror cache lives.')
+    param.add_argument('-E', '--engine', choices=['porcelain', 'plumbing'],
+                       default='porcelain',
+                       help='Merge with git merge/read-tree (default), or '
+                            'build the merge from objects and only touch '
+                            'changed files.')
+    param.add_argument('--worktree', choices=['update', 'skip'],
+                       default='update',
+                       help='With --engine plumbing, whether to update the '
+                            'index and worktree at all, skip leaves them '
+                            'at the old HEAD.')
+    param.add_argument('-C', '--combine', action='store_true',
+                       help='Merge all qcacld repos in one multi-parent '
+                            'commit, signed once (uses --engine plumbing).')
+    param.add_argument('-P', '--predict', action='store_true',
+                       help='Only fetch and report which paths would '
+                            'conflict, without touching the worktree or '
+                            'index.')
+    param.add_argument('-R', '--report', metavar='JSON',
+                       help='Write per repo step timings, objects and bytes '
+                            'fetched, commits in range and files changed '
+                            'to this file, JSON.<n> per tree in batch '
+                            'mode.')
+    param.add_argument('-B', '--batch', nargs='+', metavar='TREE',
+                       help='Merge into all these kernel trees, fetching '
+                            'once through the mirror cache.')
+    param.add_argument('-j', '--jobs', type=int, default=4,
+                       help='Kernel trees merged at once in batch mode.')
+    cache = param.add_mutually_exclusive_group()
+    cache.add_argument('--cache-size', dest='cache_action',
+                       action='store_const', const='size',
+                       help='Show mirror cache size and exit.')
+    cache.add_argument('--cache-prune', dest='cache_action',
+                       action='store_const', const='prune',
+                       help='Drop unreachable objects from the mirror '
+                            'cache and exit.')
+    cache.add_argument('--dissociate', dest='cache_action',
+                       action='store_const', const='dissociate',
+                       help='Copy borrowed objects into this kernel tree, '
+                            'so it no longer depends on the cache, and '
+                            'exit.')
     params = vars(param.parse_args())
     wlan_type = params['wlan']
     merge_type = params['init']
     tag = params['tag']
+    fetch_type = params['fetch']
+    depth = params['depth']
+    caf_url = params['url'].rstrip('/')
+    use_mirror = params['mirror']
+    cache_dir = params['cache_dir']
+    cache_action = params['cache_action']
+    batch = params['batch']
+    jobs = params['jobs']
+    predict_only = params['predict']
+    engine = params['engine']
+    worktree = params['worktree']
+    combine = params['combine']
+    report_file = params['report']
+    if combine is True:
+        engine = 'plumbing'
+    if engine == 'plumbing' and merge_type == 'update' and (
+            git_version() < (2, 38)):
+        param.error('--engine plumbing needs git merge-tree --write-tree, '
+                    'git 2.38+')
+    if batch is not None:
+        use_mirror = True
+    if cache_action is None and None in [wlan_type, merge_type, tag]:
+        param.error('-W/--wlan, -I/--init and -T/--tag are required')
+    if batch is not None and fetch_type in ['shallow', 'blobless']:
+        param.error('-B/--batch fetches through the mirror cache, which '
+                    "keeps full history locally, it can't be used with "
+                    '--fetch shallow or blobless')
+    if use_mirror is True and fetch_type in ['shallow', 'blobless']:
+        param.error('-M/--mirror already keeps full history locally, '
+                    "it can't be used with --fetch shallow or blobless")
 
 
 def repo():
     global repo_url, staging, subdirs
     staging = 'drivers/staging'
     if wlan_type == 'qcacld':
-        repo_url = {
-            'fw-api': ('https://source.codeaurora.org/'
-                       'quic/la/platform/vendor/qcom-opensource/wlan/fw-api'),
-            'qca-wifi-host-cmn': ('https://source.codeaurora.org/'
-                                  'quic/la/platform/vendor/qcom-opensource/'
-                                  'wlan/qca-wifi-host-cmn'),
-            'qcacld-3.0': ('https://source.codeaurora.org/'
-                           'quic/la/platform/vendor/qcom-opensource/wlan/'
-                           'qcacld-3.0')
-        }
         subdirs = ['fw-api', 'qca-wifi-host-cmn', 'qcacld-3.0']
     elif wlan_type == 'prima':
-        repo_url = {
-            'prima': ('https://source.codeaurora.org/'
-                      'quic/la/platform/vendor/qcom-opensource/wlan/prima')
-        }
         subdirs = ['prima']
+    repo_url = {}
+    for subdir in subdirs:
+        repo_url[subdir] = '%s/%s' % (caf_url, subdir)
 
 
 def check():
@@ -134,8 +319,8 @@ def check():
                   '\nor exists but one of them has an empty folder.' + '\n')
             raise OSError
     elif wlan_type == 'prima' and merge_type == 'initial':
-        if isdir(join(staging, subdirs)):
-            if listdir(join(staging, subdirs)):
+        if isdir(join(staging, subdirs[0])):
+            if listdir(join(staging, subdirs[0])):
                 print('\n' + 'You might want to use --init update, '
                       "\nbecause prima is exist and it's not empty." + '\n')
                 raise OSError
@@ -144,8 +329,8 @@ def check():
         else:
             return True
     elif wlan_type == 'prima' and merge_type == 'update':
-        if isdir(join(staging, subdirs)):
-            if listdir(join(staging, subdirs)):
+        if isdir(join(staging, subdirs[0])):
+            if listdir(join(staging, subdirs[0])):
                 return True
             else:
                 print("Folder prima exist, but it's just an empty folder.")
@@ -158,33 +343,35 @@ def check():
 
 def merge():
     extra_cmd = git_env()
-    merge_message = '/tmp/merge-message'
+    merge_message = MERGE_MESSAGE
+    fetch_all()
     if merge_type == 'initial':
         for repos in repo_url:
-            print("Fetching '%s' with tag '%s'" % (repos, tag))
-            cmd = 'git fetch --tags -f %s %s' % (repo_url[repos], tag)
-            subprocess_run(cmd)
-            merge_message = create_merge_message()
+            ref = wlancaf_ref(repos, tag)
+            merge_message = create_merge_message(repos)
             with open(merge_message, 'r') as commit_file:
                 commit = commit_file.read()
                 with open(merge_message, 'w') as commit_file:
                     commit_file.write(repos + ': ' + commit)
             while True:
                 cmds = [
-                    'git merge -s ours --no-commit %s FETCH_HEAD' % extra_cmd,
+                    'git merge -s ours --no-commit %s %s' % (extra_cmd, ref),
                     ('git read-tree --prefix=drivers/staging/%s '
-                     '-u FETCH_HEAD' % repos),
+                     '-u %s' % (repos, ref)),
                     ('git commit --file %s --no-edit --quiet '
                      '--gpg-sign --signoff' % merge_message)
                 ]
+                steps = ['merge', 'merge', 'commit']
                 for cmd in cmds:
-                    subprocess_run(cmd)
+                    with timed(steps[cmds.index(cmd)], repos):
+                        subprocess_run(cmd)
                     if cmd == cmds[0]:
                         print("Merging '%s' into kernel source..." % repos)
                     if cmd == cmds[1]:
                         REPO = ['qcacld-3.0', 'prima']
                         if repos in REPO:
-                            include_to_kconfig()
+                            with timed('kconfig', repos):
+                                include_to_kconfig()
                     if cmd == cmds[2]:
                         print('Committing changes...')
                         if wlan_type != 'prima':
@@ -194,15 +381,15 @@ def merge():
                             elif (sys.version_info[0] >= 3 and
                                     repos != 'qcacld-3.0'):
                                 print()
+                record_tag(repos)
+                report_files(repos, 'HEAD^1', 'HEAD')
                 if exists(merge_message):
                     os.remove(merge_message)
                 break
     elif merge_type == 'update':
         for repos in repo_url:
-            print("Fetching '%s' with tag '%s'" % (repos, tag))
-            cmd = 'git fetch --tags -f %s %s' % (repo_url[repos], tag)
-            subprocess_run(cmd)
-            merge_message = create_merge_message()
+            ref = wlancaf_ref(repos, tag)
+            merge_message = create_merge_message(repos)
             with open(merge_message, 'r') as commit_file:
                 commit = commit_file.read()
                 with open(merge_message, 'w') as commit_file:
@@ -211,19 +398,22 @@ def merge():
                 print("Merging '%s' into kernel source..."
                       % repos)
                 cmds = [
-                    ('git merge -X subtree=drivers/staging/%s FETCH_HEAD '
-                     '--no-edit' % repos),
+                    ('git merge -X subtree=drivers/staging/%s %s '
+                     '--no-edit' % (repos, ref)),
                     ('git commit --amend --file %s --no-edit --quiet '
                      '--gpg-sign --signoff' % merge_message)
                 ]
+                steps = ['merge', 'commit']
                 for cmd in cmds:
-                    talk = subprocess_run(cmd)
+                    with timed(steps[cmds.index(cmd)], repos):
+                        talk = subprocess_run(cmd)
                     if 'Already up to date.' in talk[0]:
                         print('Already up to date.')
                         break
                     else:
                         if cmd == cmds[1]:
                             print('Committing changes...')
+                            report_files(repos, 'HEAD^1', 'HEAD')
                 if wlan_type == 'qcacld':
                     if wlan_type != 'prima':
                         if (sys.version_info[0] < 3 and
@@ -232,58 +422,532 @@ def merge():
                         elif (sys.version_info[0] >= 3 and
                                 repos != 'qcacld-3.0'):
                             print()
+                record_tag(repos)
                 if exists(merge_message):
                     os.remove(merge_message)
                 break
     return
 
 
+def wlancaf_ref(repos, ref):
+    # CAF repos share tag names, keep every repo's tags apart
+    return 'refs/wlancaf/%s/%s' % (repos, ref)
+
+
+def add_promisor_remote(repos):
+    # --filter needs a promisor remote, raw URLs are not enough
+    remote = 'wlancaf-%s' % repos
+    cmds = [
+        'git config remote.%s.url %s' % (remote, repo_url[repos]),
+        'git config remote.%s.promisor true' % remote,
+        'git config remote.%s.partialclonefilter blob:none' % remote
+    ]
+    for cmd in cmds:
+        subprocess_run(cmd)
+
+
+def fetch_cmd(repos, refs, extra=''):
+    url = repo_url[repos]
+    if use_mirror is True:
+        url = mirror_path(repos)
+    elif fetch_type == 'blobless':
+        url = 'wlancaf-%s --filter=blob:none' % repos
+    if fetch_type == 'tags':
+        refspecs = '+refs/tags/*:%s' % wlancaf_ref(repos, '*')
+    else:
+        refspecs = ' '.join(['+refs/tags/%s:%s'
+                             % (ref, wlancaf_ref(repos, ref)) for ref in refs])
+    fetch = 'git fetch'
+    if report_file is not None:
+        fetch = FETCH_PROGRESS
+    # parallel fetches would all write the same FETCH_HEAD
+    if git_version() >= (2, 29):
+        extra = '--no-write-fetch-head %s' % extra
+    return '%s --no-tags %s %s %s' % (fetch, extra, url, refspecs)
+
+
+# git can't update .git/shallow from two fetches at once
+shallow_lock = threading.Lock()
+
+
+def fetch(repos, previous_tag, shallow):
+    print("Fetching '%s' with tag '%s'" % (repos, tag))
+    refs = [tag]
+    if previous_tag is not None:
+        refs.append(previous_tag)
+    extra = ''
+    if fetch_type == 'shallow' and merge_type == 'initial':
+        extra = '--depth=%d' % depth
+    with timed('fetch', repos):
+        if use_mirror is True:
+            update_mirror(repos, refs)
+        if shallow is True or extra:
+            with shallow_lock:
+                talk = subprocess_run(fetch_cmd(repos, refs, extra))
+                if merge_type == 'update':
+                    deepen(repos, previous_tag)
+        else:
+            talk = subprocess_run(fetch_cmd(repos, refs, extra))
+    report_fetched(repos, talk[1])
+
+
+def fetch_all():
+    with timed('previous_tag'):
+        previous_tag = get_previous_tag()
+    shallow = exists(join(git_dir(), 'shallow'))
+    if fetch_type == 'blobless':
+        for repos in repo_url:
+            add_promisor_remote(repos)
+    if use_mirror is True:
+        for repos in repo_url:
+            add_mirror(repos)
+    errors = []
+
+    def fetch_one(repos):
+        try:
+            fetch(repos, previous_tag, shallow)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=fetch_one, args=(repos,))
+               for repos in repo_url]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def mirror_path(repos):
+    return join(cache_dir, '%s.git' % repos)
+
+
+def add_mirror(repos):
+    # borrow objects from the mirror, fetching from it then copies nothing
+    path = mirror_path(repos)
+    if not isdir(path):
+        print("Creating mirror of '%s' in %s" % (repos, cache_dir))
+        subprocess_run('git init -q --bare %s' % path)
+    objects = os.path.abspath(join(path, 'objects'))
+    alternates = join(git_dir(), 'objects/info/alternates')
+    borrowed = []
+    if exists(alternates):
+        with open(alternates, 'r') as alternates_file:
+            borrowed = alternates_file.read().splitlines()
+    if objects not in borrowed:
+        with open(alternates, 'a') as alternates_file:
+            alternates_file.write(objects + '\n')
+
+
+def update_mirror(repos, refs):
+    path = mirror_path(repos)
+    refs = [ref for ref in refs
+            if git(path).resolve('refs/tags/%s' % ref) is None]
+    if not refs:
+        return
+    if fetch_type == 'tags':
+        refspecs = '+refs/tags/*:refs/tags/*'
+    else:
+        refspecs = ' '.join(['+refs/tags/%s:refs/tags/%s' % (ref, ref)
+                             for ref in refs])
+    print("Updating mirror of '%s'" % repos)
+    fetch = 'git fetch'
+    if report_file is not None:
+        fetch = FETCH_PROGRESS
+    talk = subprocess_run('%s --no-tags %s %s'
+                          % (fetch.replace('git', 'git -C %s'
+                                           % mirror_path(repos), 1),
+                             repo_url[repos], refspecs))
+    report_fetched(repos, talk[1])
+
+
+def batch_merge():
+    repo()
+    rundir = os.getcwd()
+    trees = [abspath(tree) for tree in batch]
+    # every tree's previous tag, so the mirrors are updated just once
+    refs = [tag]
+    for tree in trees:
+        try:
+            os.chdir(tree)
+            previous_tag = get_previous_tag()
+        except (OSError, CalledProcessError):
+            previous_tag = None
+        finally:
+            close_git(tree)
+            os.chdir(rundir)
+        if previous_tag is not None and previous_tag not in refs:
+            refs.append(previous_tag)
+    threads = []
+    for repos in repo_url:
+        if not isdir(mirror_path(repos)):
+            subprocess_run('git init -q --bare %s' % mirror_path(repos))
+        threads.append(threading.Thread(target=update_mirror,
+                                        args=(repos, refs)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cmd = [sys.executable, realpath(__file__), '-W', wlan_type,
+           '-I', merge_type, '-T', tag, '-F', fetch_type, '-U', caf_url,
+           '-M', '--cache-dir', abspath(cache_dir), '--depth', str(depth),
+           '-E', engine, '--worktree', worktree]
+    if combine is True:
+        cmd.append('-C')
+    if predict_only is True:
+        # children only report, no tree is merged
+        cmd.append('-P')
+    results = {}
+    queue = list(trees)
+    lock = threading.Lock()
+
+    def tree_report(tree):
+        # one --report per tree, JSON.1 for the first tree and so on
+        return '%s.%d' % (abspath(report_file), trees.index(tree) + 1)
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                tree = queue.pop(0)
+            if predict_only is True:
+                print('Predicting merge into %s...' % tree)
+            else:
+                print('Merging into %s...' % tree)
+            tree_cmd = list(cmd)
+            if report_file is not None:
+                tree_cmd += ['-R', tree_report(tree)]
+            try:
+                subproc = Popen(tree_cmd, stdout=PIPE, stderr=STDOUT,
+                                cwd=tree, universal_newlines=True)
+            except OSError as e:
+                results[tree] = ('failed', str(e))
+                continue
+            output = subproc.communicate()[0]
+            if subproc.returncode == 0:
+                if output.lower().count('already up to date.') == len(
+                        repo_url):
+                    status = 'up-to-date'
+                elif predict_only is True:
+                    status = 'clean'
+                else:
+                    status = 'merged'
+            elif ('Merge needs manual intervention' in output or
+                    'conflict(s):' in output):
+                status = 'conflict'
+            else:
+                status = 'failed'
+            results[tree] = (status, output)
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(jobs, len(trees))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print()
+    for tree in trees:
+        status, output = results[tree]
+        if status in ['conflict', 'failed']:
+            print('=== %s ===' % tree)
+            print(output)
+    print('Summary:')
+    for tree in trees:
+        print('  %-12s %s' % (results[tree][0], tree))
+        if report_file is not None and exists(tree_report(tree)):
+            print('  %-12s %s' % ('', 'report: ' + tree_report(tree)))
+    if [t for t in trees if results[t][0] in ['conflict', 'failed']]:
+        sys.exit(1)
+
+
+def cache_size():
+    if not isdir(cache_dir):
+        print('No mirror cache in %s' % cache_dir)
+        return
+    total = 0
+    for mirror in sorted(listdir(cache_dir)):
+        size = 0
+        for root, directories, files in os.walk(join(cache_dir, mirror)):
+            for filename in files:
+                if not islink(join(root, filename)):
+                    size += getsize(join(root, filename))
+        total += size
+        print('%-24s %10.1f MiB' % (mirror, size / 1048576.0))
+    print('%-24s %10.1f MiB' % ('total', total / 1048576.0))
+
+
+def cache_prune():
+    # only unreachable objects go, kernel trees borrowing from a mirror
+    # still find everything reachable from its tags
+    if not isdir(cache_dir):
+        return
+    for mirror in sorted(listdir(cache_dir)):
+        print("Pruning mirror '%s'" % mirror)
+        subprocess_run('git -C %s gc --quiet --prune=now'
+                       % join(cache_dir, mirror))
+    cache_size()
+
+
+def dissociate():
+    alternates = join(git_dir(), 'objects/info/alternates')
+    if not exists(alternates):
+        print('This kernel tree does not borrow objects.')
+        return
+    print('Copying borrowed objects into the kernel tree...')
+    subprocess_run('git repack -a -d -q')
+    os.remove(alternates)
+
+
+def deepen(repos, previous_tag):
+    # trees merged from a shallow fetch may lack the merge base or the
+    # previous tag history, deepen the fetched tag until both are there
+    shallow = join(git_dir(), 'shallow')
+    ref = wlancaf_ref(repos, tag)
+    while True:
+        if succeeded('git merge-base HEAD %s' % ref) and (
+                previous_tag is None or succeeded(
+                    'git merge-base --is-ancestor %s %s'
+                    % (wlancaf_ref(repos, previous_tag), ref))):
+            return
+        if not exists(shallow):
+            return
+        with open(shallow, 'r') as shallow_file:
+            before = shallow_file.read()
+        print("Deepening '%s' by %d commits..." % (repos, depth))
+        talk = subprocess_run(fetch_cmd(repos, [tag], '--deepen=%d' % depth))
+        report_fetched(repos, talk[1])
+        if not exists(shallow):
+            continue
+        with open(shallow, 'r') as shallow_file:
+            if shallow_file.read() == before:
+                return
+
+
+def git_dir():
+    return git().git_dir()
+
+
+def subtree_merge(repos, ours):
+    '''
+    (tree, conflicts) of merging the fetched tag into drivers/staging/<repos>
+    of commit ours, only in the object database.  None if up to date.
+    '''
+    prefix = join(staging, repos)
+    theirs = git().resolve(wlancaf_ref(repos, tag) + '^{commit}')
+    ours_tree = git().resolve(ours + '^{tree}')
+    theirs_tree = git().graft(ours_tree, prefix,
+                              git().resolve(theirs + '^{tree}'))
+    if merge_type == 'initial':
+        return theirs_tree, []
+    bases = git().run('merge-base', '--all', ours, theirs).split()
+    if theirs in bases:
+        return None
+    # what `merge -X subtree` does: shift base and theirs under prefix,
+    # then a plain three-way merge of whole kernel trees
+    base_tree = git().graft(ours_tree, prefix,
+                            git().resolve(bases[0] + '^{tree}'))
+    base = git().commit_tree(base_tree, message='base')
+    ours = git().commit_tree(ours_tree, [base], 'ours')
+    theirs = git().commit_tree(theirs_tree, [base], 'theirs')
+    return git().merge_tree(ours, theirs)
+
+
+def predict():
+    if merge_type == 'update' and git_version() < (2, 38):
+        print('--predict needs git merge-tree --write-tree, git 2.38+')
+        raise OSError
+    fetch_all()
+    head = git().resolve('HEAD')
+    conflicted = False
+    for repos in repo_url:
+        result = subtree_merge(repos, head)
+        if result is None:
+            print("'%s': already up to date." % repos)
+        elif result[1]:
+            conflicted = True
+            print("'%s': %d conflict(s):" % (repos, len(result[1])))
+            for path in result[1]:
+                print('    %s' % path)
+        else:
+            print("'%s': merges cleanly." % repos)
+    if conflicted is True:
+        sys.exit(1)
+
+
+def kconfig_included(ValueKconfig):
+    '''staging Kconfig with the driver sourced, None if it already is'''
+    tempRemove = 'endif # STAGING\n'
+    KconfigToInclude = None
+    if wlan_type == 'qcacld':
+        KconfigToInclude = ('source "drivers/staging/qcacld-3.0/Kconfig"'
+                            '\n\nendif # STAGING\n')
+        KconfigToCheck = 'source "drivers/staging/qcacld-3.0/Kconfig"'
+    elif wlan_type == 'prima':
+        KconfigToInclude = ('source "drivers/staging/prima/Kconfig"'
+                            '\n\nendif # STAGING\n')
+        KconfigToCheck = 'source "drivers/staging/prima/Kconfig"'
+    if KconfigToCheck in ValueKconfig:
+        return None
+    if wlan_type == 'prima':
+        print("Including 'prima' into kernel source...")
+    elif wlan_type == 'qcacld':
+        print("Including 'qcacld-3.0' into kernel source...")
+    return ValueKconfig.replace(tempRemove, KconfigToInclude)
+
+
+def makefile_included(MakefileValue):
+    '''staging Makefile building the driver, None if it already does'''
+    if wlan_type == 'qcacld':
+        ValueToCheck = 'CONFIG_QCA_CLD_WLAN'
+        ValueToInclude = 'obj-$(CONFIG_QCA_CLD_WLAN)\t+= qcacld-3.0/'
+    elif wlan_type == 'prima':
+        ValueToCheck = 'CONFIG_PRONTO_WLAN'
+        ValueToInclude = 'obj-$(CONFIG_PRONTO_WLAN)\t+= prima/'
+    if ValueToCheck in MakefileValue:
+        return None
+    return MakefileValue + ValueToInclude
+
+
 def include_to_kconfig():
     if merge_type == 'initial':
-        tempRemove = 'endif # STAGING\n'
-        KconfigToInclude = None
-        if wlan_type == 'qcacld':
-            KconfigToInclude = ('source "drivers/staging/qcacld-3.0/Kconfig"'
-                                '\n\nendif # STAGING\n')
-            KconfigToCheck = 'source "drivers/staging/qcacld-3.0/Kconfig"'
-        elif wlan_type == 'prima':
-            KconfigToInclude = ('source "drivers/staging/prima/Kconfig"'
-                                '\n\nendif # STAGING\n')
-            KconfigToCheck = 'source "drivers/staging/prima/Kconfig"'
         with open(join(staging, 'Kconfig'), 'r') as Kconfig:
-            ValueKconfig = Kconfig.read()
-        if KconfigToCheck not in ValueKconfig:
-            if wlan_type == 'prima':
-                print("Including 'prima' into kernel source...")
-            elif wlan_type == 'qcacld':
-                print("Including 'qcacld-3.0' into kernel source...")
+            NewKconfig = kconfig_included(Kconfig.read())
+        if NewKconfig is not None:
             with open(join(staging, 'Kconfig'), 'w') as Kconfig:
-                NewKconfig = ValueKconfig.replace(tempRemove, KconfigToInclude)
                 Kconfig.write(NewKconfig)
             include_to_makefile()
-            cmds = ['git add drivers/staging/Kconfig',
-                    'git add drivers/staging/Makefile']
-            for cmd in cmds:
-                subprocess_run(cmd)
+            git().run('add', 'drivers/staging/Kconfig',
+                      'drivers/staging/Makefile')
     return
 
 
 def include_to_makefile():
     if merge_type == 'initial':
         with open(join(staging, 'Makefile'), 'r') as Makefile:
-            MakefileValue = Makefile.read()
-        if wlan_type == 'qcacld':
-            ValueToCheck = 'CONFIG_QCA_CLD_WLAN'
-            ValueToInclude = 'obj-$(CONFIG_QCA_CLD_WLAN)\t+= qcacld-3.0/'
-        elif wlan_type == 'prima':
-            ValueToCheck = 'CONFIG_PRONTO_WLAN'
-            ValueToInclude = 'obj-$(CONFIG_PRONTO_WLAN)\t+= prima/'
-        if ValueToCheck not in MakefileValue:
-            with open(join(staging, 'Makefile'), 'a') as Makefile:
-                Makefile.write(ValueToInclude)
+            NewMakefile = makefile_included(Makefile.read())
+        if NewMakefile is not None:
+            with open(join(staging, 'Makefile'), 'w') as Makefile:
+                Makefile.write(NewMakefile)
     return
 
 
+def include_in_tree(tree):
+    # include_to_kconfig for plumbing merges, edits blobs instead of files
+    for name, include in [('Kconfig', kconfig_included),
+                          ('Makefile', makefile_included)]:
+        path = '%s/%s' % (staging, name)
+        value = git().read('%s:%s' % (tree, path))[1].decode('utf-8')
+        value = include(value)
+        if value is None:
+            break
+        blob = git().hash_object(value.encode('utf-8'))
+        tree = git().graft(tree, path, blob, '100644', 'blob')
+    return tree
+
+
+def plumbing_merge():
+    # build the merged trees and commits from objects, then move HEAD and
+    # touch only what changed in the worktree (or nothing with --worktree
+    # skip)
+    fetch_all()
+    old_head = head = git().resolve('HEAD')
+    merged = []
+    changed = []
+    parents = [old_head]
+    heads = [old_head]
+    ident = git().run('var', 'GIT_COMMITTER_IDENT').strip().rsplit(' ', 2)[0]
+    for repos in repo_url:
+        print("Merging '%s' into kernel source..." % repos)
+        with timed('merge', repos):
+            result = subtree_merge(repos, head)
+        if result is None:
+            print('Already up to date.')
+            merged.append(repos)
+            continue
+        tree, conflicts = result
+        if conflicts:
+            print('Conflict(s) in:')
+            for path in conflicts:
+                print('    %s' % path)
+            print('Merge needs manual intervention!.')
+            print('Run again with --engine porcelain to resolve them, '
+                  'nothing has been changed.')
+            sys.exit(1)
+        if merge_type == 'initial' and repos in ['qcacld-3.0', 'prima']:
+            with timed('kconfig', repos):
+                tree = include_in_tree(tree)
+        theirs = git().resolve(wlancaf_ref(repos, tag) + '^{commit}')
+        parents.append(theirs)
+        changed.append(repos)
+        merged.append(repos)
+        if combine is True:
+            # unsigned stepping stone, only so the next repo finds its
+            # merge base, the final commit replaces it
+            with timed('commit', repos):
+                step = git().commit_tree(tree, [head, theirs], repos)
+            report_files(repos, head, step)
+            head = step
+            heads.append(head)
+            continue
+        merge_message = create_merge_message(repos)
+        with open(merge_message, 'r') as commit_file:
+            message = repos + ': ' + commit_file.read()
+        os.remove(merge_message)
+        message += 'Signed-off-by: %s\n' % ident
+        print('Committing changes...')
+        with timed('commit', repos):
+            step = git().commit_tree(tree, [head, theirs], message, sign=True)
+        report_files(repos, head, step)
+        head = step
+        heads.append(head)
+    if combine is True and len(parents) > 1:
+        message = create_combined_message(changed)
+        message += 'Signed-off-by: %s\n' % ident
+        print('Committing changes...')
+        with timed('commit'):
+            head = git().commit_tree(tree, parents, message, sign=True)
+    if head != old_head:
+        if worktree == 'update':
+            print('Updating changed files in the worktree...')
+            with timed('worktree'):
+                # read-tree -m trusts the index stat data, refresh it first
+                git().run('update-index', '-q', '--refresh')
+                if fetch_type != 'blobless':
+                    heads = [old_head, head]
+                # a lazy fetch asks one promisor remote for every missing
+                # blob, so blobless trees are checked out repo by repo
+                for old, new in zip(heads, heads[1:]):
+                    git().run('read-tree', '-m', '-u', old, new)
+        git().run('update-ref', '-m', 'wlancaf-merge: %s' % tag, 'HEAD',
+                  head, old_head)
+    # only once HEAD has them, a conflict above leaves the index as it was
+    for repos in merged:
+        record_tag(repos)
+
+
+def tag_index():
+    # {path: {revision: tag}}, the last CAF tag merged into each subtree
+    return join(git_dir(), 'wlancaf-tags.json')
+
+
+def load_tag_index():
+    if not exists(tag_index()):
+        return {}
+    with open(tag_index(), 'r') as index_file:
+        return json.load(index_file)
+
+
+def save_tag_index(path, merged_tag):
+    index = load_tag_index()
+    index.setdefault(path, {})[merged_tag.split('-')[0]] = merged_tag
+    with open(tag_index(), 'w') as index_file:
+        json.dump(index, index_file, indent=4, sort_keys=True)
+
+
+def record_tag(repos):
+    save_tag_index(join(staging, repos), tag)
+
+
 def get_previous_tag():
     revision = tag.split('-')[0]
     if merge_type == 'initial':
@@ -293,51 +957,70 @@ def get_previous_tag():
         path = 'drivers/staging/qcacld-3.0'
     elif wlan_type == 'prima':
         path = 'drivers/staging/prima'
-    cmd = ("git log --pretty=format:'%s' %s | grep '%s' "
-           "| head -n 1" % ('%s', path, revision))
-    talk = subprocess_run(cmd)
-    if talk[0] is None:
+    previous_tag = load_tag_index().get(path, {}).get(revision)
+    # the index is per repository, another branch or a reset HEAD may not
+    # have that tag merged
+    if previous_tag is not None and succeeded(
+            'git merge-base --is-ancestor %s HEAD'
+            % wlancaf_ref(path.split('/')[-1], previous_tag)):
+        return previous_tag
+    # merged before the index existed, or not into this HEAD, search the
+    # history once. --grep matches bodies too, the tag is in the subject
+    subjects = git().log(['HEAD'], paths=[path],
+                         options=['-F', '--grep=%s' % revision])
+    subjects = [s for s in subjects if revision in s][:1]
+    comm = ' '.join(subjects).replace("'", '').split()
+    val = [t for t in comm if revision in t]
+    try:
+        previous_tag = val[0]
+    except IndexError:
         previous_tag = None
-    else:
-        comm = talk[0].strip('\n').replace("'", '').split()
-        val = [t for t in comm if revision in t]
-        try:
-            previous_tag = val[0]
-        except IndexError:
-            previous_tag = None
+    if previous_tag is not None:
+        save_tag_index(path, previous_tag)
     return previous_tag
 
 
-def create_merge_message():
-    merge_message = '/tmp/merge-message'
-    previous_tag = get_previous_tag()
-    tags = 'None'
-    cmds = [
-            'git rev-parse --abbrev-ref HEAD',
-            'git rev-list --count %s' % tags,
-            ('git log --oneline --pretty=format:"        %s" "%s"'
-             % ('%s', tags))
-    ]
+def tag_changes(repos, previous_tag):
+    '''(count, indented subjects) of what the tag brings into repos'''
     if previous_tag is not None and merge_type == 'update':
-        range = 'refs/tags/%s..refs/tags/%s' % (previous_tag, tag)
-        for cmd, value in enumerate(cmds):
-            cmds[cmd] = value.replace(tags, range)
-    elif previous_tag is None and merge_type == 'initial':
-        for cmd, value in enumerate(cmds):
-            cmds[cmd] = value.replace(tags, tag)
+        revs = ['%s..%s' % (wlancaf_ref(repos, previous_tag),
+                            wlancaf_ref(repos, tag))]
+    else:
+        revs = [wlancaf_ref(repos, tag)]
+    # count and subjects from a single git log
+    lines = git().log(revs, fmt='%H %s')
+    subjects = [line.split(' ', 1)[1] for line in lines]
+    total_changes = len(subjects)
+    report_add(repos, 'commits', total_changes)
+    shallow = join(git_dir(), 'shallow')
+    if exists(shallow):
+        with open(shallow, 'r') as shallow_file:
+            boundary = set(shallow_file.read().split())
+        if [line for line in lines if line.split(' ', 1)[0] in boundary]:
+            # history is cut at --depth, the real count is unknown
+            total_changes = 'at least %d' % total_changes
+    if merge_type == 'initial':
         # don't add all commit changes in initial
-        command = ('git log --oneline --pretty=oneline -45 --pretty=format'
-                   ':"        %s" "%s"' % ('%s', tag))
-        for cmd, value in enumerate(cmds):
-            cmds[cmd] = value.replace(cmds[2], command)
-    for cmd in cmds:
-        talk = subprocess_run(cmd)
-        if cmd == cmds[0]:
-            branch = talk[0].strip('\n')
-        if cmd == cmds[1]:
-            total_changes = talk[0].strip('\n')
-        if cmd == cmds[2]:
-            commits = talk[0]
+        subjects = subjects[:45]
+    commits = '\n'.join(['        ' + subject for subject in subjects])
+    if merge_type == 'initial':
+        commits += '\n' + '        ...'
+    return total_changes, commits
+
+
+def create_merge_message(repos):
+    # timed on its own, not as part of the message
+    with timed('previous_tag', repos):
+        previous_tag = get_previous_tag()
+    with timed('message', repos):
+        return write_merge_message(repos, previous_tag)
+
+
+def write_merge_message(repos, previous_tag):
+    merge_message = MERGE_MESSAGE
+    total_changes, commits = tag_changes(repos, previous_tag)
+    # branch from .git/HEAD
+    branch = git().branch()
     with open(merge_message, 'w+') as commit_msg:
         if merge_type == 'initial':
             commit_msg.write("Initial tag '%s' into %s" % (tag, branch))
@@ -351,13 +1034,44 @@ def create_merge_message():
                          % (tag, total_changes))
         commit_msg.writelines('\n')
         commit_msg.write(commits)
-        if merge_type == 'initial':
-            commit_msg.write('\n' + '        ...')
+        commit_msg.write('\n\nCAF-Tag: %s\n' % tag)
     return merge_message
 
 
+def create_combined_message(merged):
+    with timed('previous_tag'):
+        previous_tag = get_previous_tag()
+    with timed('message'):
+        return combined_message(merged, previous_tag)
+
+
+def combined_message(merged, previous_tag):
+    # one message for every repo merged by --combine
+    branch = git().branch()
+    if merge_type == 'initial':
+        message = "%s: Initial tag '%s' into %s\n\n" % (wlan_type, tag, branch)
+        message += ('This is an initial merged, '
+                    'all commit changes will not be written fully.\n')
+    else:
+        message = "%s: Merge tag '%s' into %s\n\n" % (wlan_type, tag, branch)
+    for repos in merged:
+        total_changes, commits = tag_changes(repos, previous_tag)
+        message += ("Changes in '%s' tag '%s': (%s commits)\n%s\n"
+                    % (repos, tag, total_changes, commits))
+    return message + '\nCAF-Tag: %s\n' % tag
+
+
 def main():
     print()
+    started = time.time()
+    try:
+        merge_all()
+    finally:
+        if report_file is not None:
+            write_report(started)
+
+
+def merge_all():
     repo()
     if not exists('Makefile'):
         print('Run this script inside your root kernel source.')
@@ -367,11 +1081,25 @@ def main():
               'are you sure running it inside kernel source?')
         raise OSError
     if check() is True:
-        merge()
-    if exists('/tmp/merge-message'):
-        os.remove('/tmp/merge-message')
+        if predict_only is True:
+            predict()
+        elif engine == 'plumbing':
+            plumbing_merge()
+        else:
+            merge()
+    if exists(MERGE_MESSAGE):
+        os.remove(MERGE_MESSAGE)
 
 
 if __name__ == '__main__':
     parameters()
-    main()
+    if cache_action == 'size':
+        cache_size()
+    elif cache_action == 'prune':
+        cache_prune()
+    elif cache_action == 'dissociate':
+        dissociate()
+    elif batch is not None:
+        batch_merge()
+    else:
+        main()